@@ -0,0 +1,255 @@
+
+###
+###
+###
+### AMBBenchmark.py generates a corpus of synthetic AMB files and measures how fast AMBReader.py loads, checks, and describes them. Since the
+### corpus is generated it doesn't need a Civ 3 install, so it can be run anywhere to compare performance between versions of the reader. The
+### generated files follow the layout in AMBFormat.org: PRGM, KMAP, and GLBL chunks followed by a MIDI whose info track has a name, SMPTE offset,
+### time signature, and tempo, and whose sound tracks have a name, control changes (written with running status), a program change, and notes.
+### BASIC USAGE:
+###   py AMBBenchmark.py --files 2000 --output results.json
+### See "py AMBBenchmark.py --help" for all options. The functions can also be used from the interpreter, e.g.:
+###   >>> generate_amb_corpus ("synthetic", 100)
+###   >>> run_benchmarks ("synthetic")
+###
+###
+###
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+
+# Importing AMBReader prints how many AMBs it found in the install set in civ3_root_dir, which doesn't matter here
+with contextlib.redirect_stdout (io.StringIO ()):
+    import AMBReader
+
+#
+# Synthetic corpus generation
+#
+
+def encode_var_int (value):
+    tr = [value & 0x7F]
+    value >>= 7
+    while value > 0:
+        tr.append ((value & 0x7F) | 0x80)
+        value >>= 7
+    tr.reverse ()
+    return bytes (tr)
+
+def make_prgm_chunk (number, effect_name, var_name, rng):
+    dat = [3, rng.choice ([0, 100, 150, 200]), -rng.choice ([0, 100, 200]), 127, rng.choice ([0, 75, 127])]
+    contents = struct.pack ("<I5iI", number, *dat, 0xFA) + effect_name.encode () + b"\0" + var_name.encode () + b"\0"
+    return b"prgm" + struct.pack ("<I", len (contents)) + contents
+
+def make_kmap_chunk (var_name, wave_name):
+    contents = (struct.pack ("<3I", 2, 0, 0) + var_name.encode () + b"\0" + struct.pack ("<2I", 1, 12) + bytes ([0x7F, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0]) +
+                wave_name.encode () + b"\0" + struct.pack ("<I", 0xFA))
+    return b"kmap" + struct.pack ("<I", len (contents)) + contents
+
+def make_glbl_chunk ():
+    return b"glbl" + struct.pack ("<2I", 16, 12) + bytes ([0, 0, 0, 0, 0, 0, 0, 0, 0xCD, 0xCD, 0xCD, 0xCD])
+
+def make_track_name_event (delta_time, name):
+    return encode_var_int (delta_time) + b"\xFF\x03" + encode_var_int (len (name)) + name.encode ()
+
+def make_info_track (microseconds_per_quarter_note):
+    events = (make_track_name_event (0, "Seq-1") +
+              encode_var_int (0) + b"\xFF\x54\x05" + bytes ([0x60, 0, 3, 0, 0]) +
+              encode_var_int (0) + b"\xFF\x58\x04" + bytes ([4, 2, 24, 8]) +
+              encode_var_int (0) + b"\xFF\x51\x03" + microseconds_per_quarter_note.to_bytes (3, "big") +
+              encode_var_int (0) + b"\xFF\x2F\x00")
+    return b"MTrk" + struct.pack (">I", len (events)) + events
+
+# A sound track holds about event_count channel events: two control changes, a program change, then as many NoteOn/NoteOff pairs as fit (at
+# least one). With running_status, the second control change leaves out its status byte.
+def make_sound_track (name, channel, program, event_count, running_status, rng):
+    events = [make_track_name_event (0, name),
+              encode_var_int (0) + bytes ([0xB0 | channel, 7, rng.randint (64, 127)]),
+              encode_var_int (0) + (b"" if running_status else bytes ([0xB0 | channel])) + bytes ([10, 64]),
+              encode_var_int (0) + bytes ([0xC0 | channel, program])]
+    for n in range (max (1, (event_count - 3) // 2)):
+        events.append (encode_var_int (rng.randint (0, 2000)) + bytes ([0x90 | channel, 60, 127]))
+        events.append (encode_var_int (rng.randint (50, 1000)) + bytes ([0x80 | channel, 60, 0]))
+    events.append (encode_var_int (0) + b"\xFF\x2F\x00")
+    events = b"".join (events)
+    return b"MTrk" + struct.pack (">I", len (events)) + events
+
+# Returns the contents of an AMB file playing one sound per entry in effect_names
+def make_amb (effect_names, events_per_track, running_status, rng):
+    chunks = [make_prgm_chunk (n + 1, name, "Var" + name, rng) for (n, name) in enumerate (effect_names)]
+    chunks += [make_kmap_chunk ("Var" + name, name + ".wav") for name in effect_names]
+    chunks.append (make_glbl_chunk ())
+    tracks = [make_info_track (rng.choice ([500000, 600000, 1000000]))]
+    tracks += [make_sound_track (name, n % 16, n + 1, events_per_track, running_status, rng) for (n, name) in enumerate (effect_names)]
+    chunks.append (b"MThd" + struct.pack (">IHHH", 6, 1, len (tracks), 480))
+    return b"".join (chunks + tracks)
+
+amb_kinds = ["Attack", "Run", "Death", "Fidget", "Victory", "Fortify", "Build", "Default"]
+
+# Writes file_count synthetic AMBs into unit folders under output_dir/Art/Units, as in a Civ 3 install. Each file has tracks_per_file sound tracks
+# (plus the info track) with events_per_track channel events each. Generation is deterministic for a given seed. Returns the list of art directories
+# holding the corpus, to be passed to AmbCatalog.
+def generate_amb_corpus (output_dir, file_count, tracks_per_file = 4, events_per_track = 5, running_status = True, seed = 0):
+    rng = random.Random (seed)
+    art_path = os.path.join (output_dir, "Art", "Units")
+    for n in range (file_count):
+        unit_name = "Unit" + str (n // len (amb_kinds))
+        file_name = unit_name + amb_kinds[n % len (amb_kinds)]
+        unit_folder = os.path.join (art_path, unit_name)
+        os.makedirs (unit_folder, exist_ok = True)
+        effect_names = [file_name + str (k) for k in range (tracks_per_file)]
+        with open (os.path.join (unit_folder, file_name + ".amb"), "wb") as amb_file:
+            amb_file.write (make_amb (effect_names, events_per_track, running_status, rng))
+    return [art_path]
+
+#
+# Benchmarks
+#
+
+# Returns the peak resident set size of this process in bytes, or None if it can't be found on this platform
+def get_peak_rss ():
+    try:
+        import resource
+        peak = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024 # macOS reports bytes, Linux reports kilobytes
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        import ctypes.wintypes
+        class ProcessMemoryCounters (ctypes.Structure):
+            _fields_ = [("cb", ctypes.wintypes.DWORD), ("PageFaultCount", ctypes.wintypes.DWORD), ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t), ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = ProcessMemoryCounters ()
+        counters.cb = ctypes.sizeof (counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess ()
+        if ctypes.windll.psapi.GetProcessMemoryInfo (process, ctypes.byref (counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except Exception:
+        pass
+    return None
+
+def count_events (amb):
+    return sum ([len (t.events) for t in amb.midi.tracks])
+
+# Each benchmark takes the art directories of the corpus and the number of repetitions and returns (best time in seconds, number of events
+# processed). Only the work being measured is timed, e.g. the describe benchmark loads the files before starting the clock.
+
+def benchmark_loading (art_paths, repeat):
+    paths = AMBReader.list_amb_paths (art_paths)
+    best_time = None
+    for n in range (repeat):
+        start_time = time.perf_counter ()
+        loaded = [AMBReader.Amb (p) for p in paths]
+        elapsed = time.perf_counter () - start_time
+        best_time = elapsed if best_time is None else min (best_time, elapsed)
+    return (best_time, sum ([count_events (a) for a in loaded]))
+
+def benchmark_investigate_format (art_paths, repeat):
+    best_time = None
+    for n in range (repeat):
+        catalog = AMBReader.AmbCatalog (art_paths)
+        start_time = time.perf_counter ()
+        with contextlib.redirect_stdout (io.StringIO ()):
+            AMBReader.investigate_format (catalog)
+        elapsed = time.perf_counter () - start_time
+        best_time = elapsed if best_time is None else min (best_time, elapsed)
+    return (best_time, sum ([count_events (a) for a in catalog.values ()]))
+
+def benchmark_describe (art_paths, repeat):
+    loaded = [AMBReader.Amb (p) for p in AMBReader.list_amb_paths (art_paths)]
+    best_time = None
+    with open (os.devnull, "w") as devnull:
+        for n in range (repeat):
+            for a in loaded:
+                a.midi.timeline = None
+            start_time = time.perf_counter ()
+            with contextlib.redirect_stdout (devnull):
+                for a in loaded:
+                    a.describe ()
+            elapsed = time.perf_counter () - start_time
+            best_time = elapsed if best_time is None else min (best_time, elapsed)
+    return (best_time, sum ([count_events (a) for a in loaded]))
+
+benchmarks = {"load": benchmark_loading,
+              "investigate_format": benchmark_investigate_format,
+              "describe": benchmark_describe}
+
+# Runs one benchmark and returns its time & event count along with the peak memory use of the process. Called in a fresh process for each benchmark
+# so the peak reflects only that benchmark.
+def run_benchmark_in_process (name, art_paths, repeat):
+    (seconds, event_count) = benchmarks[name] (art_paths, repeat)
+    return (seconds, event_count, get_peak_rss ())
+
+# Runs the benchmarks on the corpus under corpus_dir, each in its own process, and returns the results as a dict ready to be written as JSON.
+# label is stored with the results to tell runs apart, e.g. a version number or commit hash.
+def run_benchmarks (corpus_dir, names = None, repeat = 3, label = None):
+    art_paths = [os.path.join (corpus_dir, "Art", "Units")]
+    paths = AMBReader.list_amb_paths (art_paths)
+    byte_count = sum ([os.path.getsize (p) for p in paths])
+    results = {}
+    context = multiprocessing.get_context ("spawn")
+    for name in (names if names is not None else list (benchmarks)):
+        with concurrent.futures.ProcessPoolExecutor (max_workers = 1, mp_context = context) as executor:
+            (seconds, event_count, peak_rss) = executor.submit (run_benchmark_in_process, name, art_paths, repeat).result ()
+        results[name] = {"seconds": seconds,
+                         "files_per_second": len (paths) / seconds,
+                         "mb_per_second": byte_count / seconds / 1e6,
+                         "events_per_second": event_count / seconds,
+                         "peak_rss_bytes": peak_rss}
+        print ("{:<20}{:8.3f} s{:10.0f} files/s{:8.2f} MB/s{:12.0f} events/s   peak RSS {}".format (name, seconds, len (paths) / seconds,
+                byte_count / seconds / 1e6, event_count / seconds, "{:.1f} MB".format (peak_rss / 1e6) if peak_rss is not None else "unknown"))
+    return {"label": label,
+            "time": time.strftime ("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split ()[0],
+            "platform": platform.platform (),
+            "corpus": {"path": corpus_dir, "files": len (paths), "bytes": byte_count},
+            "repeat": repeat,
+            "results": results}
+
+def main (argv = None):
+    parser = argparse.ArgumentParser (description = "Generate a synthetic AMB corpus and benchmark AMBReader on it")
+    parser.add_argument ("--corpus-dir", help = "directory holding the corpus. It's generated if it doesn't contain one yet. Defaults to a temporary directory")
+    parser.add_argument ("--files", type = int, default = 1000, help = "number of AMB files to generate")
+    parser.add_argument ("--tracks", type = int, default = 4, help = "sound tracks per file")
+    parser.add_argument ("--events", type = int, default = 5, help = "channel events per sound track")
+    parser.add_argument ("--no-running-status", action = "store_true", help = "write every MIDI status byte")
+    parser.add_argument ("--seed", type = int, default = 0)
+    parser.add_argument ("--repeat", type = int, default = 3, help = "times to repeat each benchmark, the best time is reported")
+    parser.add_argument ("--benchmark", action = "append", choices = list (benchmarks), help = "benchmark to run, may be repeated. Defaults to all")
+    parser.add_argument ("--label", help = "label stored with the results, e.g. a commit hash")
+    parser.add_argument ("--output", help = "file to write the results to as JSON")
+    args = parser.parse_args (argv)
+
+    with tempfile.TemporaryDirectory () as temp_dir:
+        corpus_dir = args.corpus_dir if args.corpus_dir is not None else temp_dir
+        generated = len (AMBReader.list_amb_paths ([os.path.join (corpus_dir, "Art", "Units")])) == 0
+        if generated:
+            start_time = time.perf_counter ()
+            generate_amb_corpus (corpus_dir, args.files, args.tracks, args.events, not args.no_running_status, args.seed)
+            print ("Generated {} AMB files in {:.2f} s".format (args.files, time.perf_counter () - start_time))
+        report = run_benchmarks (corpus_dir, args.benchmark, args.repeat, args.label)
+        if generated:
+            report["corpus"].update ({"tracks_per_file": args.tracks, "events_per_track": args.events, "running_status": not args.no_running_status,
+                                      "seed": args.seed})
+
+    if args.output is not None:
+        with open (args.output, "w") as output_file:
+            json.dump (report, output_file, indent = 2)
+            output_file.write ("\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
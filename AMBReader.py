@@ -5,8 +5,8 @@
 ### AMBReader.py is a script I've been using to explore & experiment with AMB files. In the process I've also built it up as an AMB reader, though
 ### it's by no means a user friendly format loading library.
 ### BASIC USAGE: First set civ3_root_dir below to your Civ 3 install directory. Then run the script in interactive mode (py -i AMBReader.py). It will
-### automatically load all AMBs from your vanilla, PTW, and Conquests installs. You can look up an AMB by name using the "find_amb" method and print
-### out its contents using its "describe" method. For example, try:
+### automatically find all AMBs from your vanilla, PTW, and Conquests installs, each one is loaded the first time it's needed. You can look up an AMB
+### by name using the "find_amb" method and print out its contents using its "describe" method. For example, try:
 ###   >>> find_amb("TrebuchetRun").describe()
 ###
 ###
@@ -14,68 +14,162 @@
 
 civ3_root_dir = "/media/c/GOG Games/Civilization III Complete/" # "C:\\GOG Games\\Civilization III Complete\\"
 
+# Optionally set this to a directory where parsed AMBs will be cached between sessions, e.g. os.path.expanduser ("~/.cache/civ3amb")
+amb_cache_dir = None
 
+# Set this to True to record where time goes while loading AMBs, see AmbProfiler. Can also be turned on later with amb_profiler.enable ().
+profile_amb_loading = False
 
+# Set this to True to share identical chunks, tracks, and files between the AMBs in the catalog (see AmbInternTable). This saves memory on installs
+# that repeat many units but makes loading slower when there's little to share, and AMBs returned by find_amb may then share objects with others,
+# so they must not be edited in place. Load a separate copy with Amb (path) to edit instead.
+share_identical_ambs = False
+
+
+
+import argparse
+import array
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import hashlib
+import heapq
+import json
 import os
+import math
+import pickle
+import random
+import sqlite3
+import struct
+import sys
+import time
+import wave
+import weakref
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 civ3_unit_art_paths = [os.path.join (civ3_root_dir             , "Art", "Units"),
                        os.path.join (civ3_root_dir, "civ3PTW"  , "Art", "Units"),
                        os.path.join (civ3_root_dir, "Conquests", "Art", "Units")]
 
-def read_string (_file):
-    tr = b""
-    while True:
-        byte = _file.read (1)
-        if byte[0] != 0:
-            tr += byte
-        else:
-            break
-    return tr.decode ()
+# Holds the entire contents of an AMB file in memory. Chunks are decoded directly out of the buffer by moving an offset along it, which is much
+# faster than issuing a separate small read on a file object for every field. The interface mirrors the bits of the file API the parser used to
+# rely on (read & tell) so the chunk classes read almost the same as before.
+class AmbBuffer:
+    def __init__ (self, data, file_path = None):
+        self.data = data
+        self.view = memoryview (data)
+        self.pos = 0
+        self.file_path = file_path
 
-def read_amb_int (_file, unsigned = True):
-    return int.from_bytes (_file.read (4), byteorder = "little", signed = not unsigned)
+    def read (self, n):
+        start = self.pos
+        if start + n > len (self.data):
+            raise self.eof_exception (n)
+        self.pos = start + n
+        return self.data[start:self.pos]
+
+    def tell (self):
+        return self.pos
+
+    # Returns the exception raised by read when fewer than n bytes are left. Code that unpacks fields straight out of data checks the length itself
+    # and raises this so truncated files always fail the same way.
+    def eof_exception (self, n):
+        return Exception ("Unexpected EOF reading " + str (n) + " bytes at offset " + str (self.pos))
+
+amb_uint_struct    = struct.Struct ("<I")
+amb_int_struct     = struct.Struct ("<i")
+midi_uint_struct   = struct.Struct (">I")
+midi_int_struct    = struct.Struct (">i")
+midi_ushort_struct = struct.Struct (">H")
+midi_short_struct  = struct.Struct (">h")
+
+def read_string (buf):
+    end = buf.data.find (b"\0", buf.pos)
+    if end < 0:
+        raise Exception ("Unexpected EOF in null-terminated string")
+    tr = str (buf.view[buf.pos:end], "utf-8")
+    buf.pos = end + 1
+    return tr
 
-def read_midi_int (_file, unsigned = True):
-    return int.from_bytes (_file.read (4), byteorder = "big", signed = not unsigned)
+def read_byte (buf):
+    if buf.pos >= len (buf.data):
+        raise Exception ("Unexpected EOF reading 1 byte at offset " + str (buf.pos))
+    tr = buf.data[buf.pos]
+    buf.pos += 1
+    return tr
+
+def read_amb_int (buf, unsigned = True):
+    if buf.pos + 4 > len (buf.data):
+        raise buf.eof_exception (4)
+    (tr,) = (amb_uint_struct if unsigned else amb_int_struct).unpack_from (buf.data, buf.pos)
+    buf.pos += 4
+    return tr
 
-def read_midi_short (_file, unsigned = True):
-    return int.from_bytes (_file.read (2), byteorder = "big", signed = not unsigned)
+def read_midi_int (buf, unsigned = True):
+    if buf.pos + 4 > len (buf.data):
+        raise buf.eof_exception (4)
+    (tr,) = (midi_uint_struct if unsigned else midi_int_struct).unpack_from (buf.data, buf.pos)
+    buf.pos += 4
+    return tr
+
+def read_midi_short (buf, unsigned = True):
+    if buf.pos + 2 > len (buf.data):
+        raise buf.eof_exception (2)
+    (tr,) = (midi_ushort_struct if unsigned else midi_short_struct).unpack_from (buf.data, buf.pos)
+    buf.pos += 2
+    return tr
 
 # Reads a "variable length quantity", which is an int made up of a variable number of bytes. Each byte contains 7 bits of the int and the 8th
 # (highest) bit determines whether or not the next byte is included as well.
-def read_midi_var_int (_file):
+def read_midi_var_int (buf):
+    data = buf.data
+    pos = buf.pos
+    if pos < len (data) and data[pos] < 0x80: # Fast path for single byte quantities, which covers most delta times
+        buf.pos = pos + 1
+        return data[pos]
     tr = 0
-    while True:
-        bs = _file.read (1)
-        if len (bs) > 0:
-            tr = (tr << 7) + (bs[0] & 0x7F)
-            if (bs[0] & 0x80) == 0:
-                return tr
-        else:
-            raise Exception ("Unexpected EOF in variable length quantity")
-
-# assert   0       == read_midi_var_int (b"\x00")
-# assert 0x40      == read_midi_var_int (b"\x40")
-# assert 0x7F      == read_midi_var_int (b"\x7F")
-# assert 0x80      == read_midi_var_int (b"\x81\x00")
-# assert 0x2000    == read_midi_var_int (b"\xC0\x00")
-# assert 0x3FFF    == read_midi_var_int (b"\xFF\x7F")
-# assert 0x4000    == read_midi_var_int (b"\x81\x80\x00")
-# assert 0x100000  == read_midi_var_int (b"\xC0\x80\x00")
-# assert 0x1FFFFF  == read_midi_var_int (b"\xFF\xFF\x7F")
-# assert 0x200000  == read_midi_var_int (b"\x81\x80\x80\x00")
-# assert 0x8000000 == read_midi_var_int (b"\xC0\x80\x80\x00")
-# assert 0xFFFFFFF == read_midi_var_int (b"\xFF\xFF\xFF\x7F")
+    while pos < len (data):
+        byte = data[pos]
+        pos += 1
+        tr = (tr << 7) + (byte & 0x7F)
+        if (byte & 0x80) == 0:
+            buf.pos = pos
+            return tr
+    raise Exception ("Unexpected EOF in variable length quantity")
+
+# assert   0       == read_midi_var_int (AmbBuffer (b"\x00"))
+# assert 0x40      == read_midi_var_int (AmbBuffer (b"\x40"))
+# assert 0x7F      == read_midi_var_int (AmbBuffer (b"\x7F"))
+# assert 0x80      == read_midi_var_int (AmbBuffer (b"\x81\x00"))
+# assert 0x2000    == read_midi_var_int (AmbBuffer (b"\xC0\x00"))
+# assert 0x3FFF    == read_midi_var_int (AmbBuffer (b"\xFF\x7F"))
+# assert 0x4000    == read_midi_var_int (AmbBuffer (b"\x81\x80\x00"))
+# assert 0x100000  == read_midi_var_int (AmbBuffer (b"\xC0\x80\x00"))
+# assert 0x1FFFFF  == read_midi_var_int (AmbBuffer (b"\xFF\xFF\x7F"))
+# assert 0x200000  == read_midi_var_int (AmbBuffer (b"\x81\x80\x80\x00"))
+# assert 0x8000000 == read_midi_var_int (AmbBuffer (b"\xC0\x80\x80\x00"))
+# assert 0xFFFFFFF == read_midi_var_int (AmbBuffer (b"\xFF\xFF\xFF\x7F"))
 
 class Prgm:
-    def __init__ (self, amb_file):
+    __slots__ = ("size", "number", "dat", "str1", "str2", "__weakref__")
+
+    def __init__ (self, buf):
         # Size does not include the type tag or size field itself. The AMB reader code checks if size == 0x1C, implying it's possible for prgm chunks
         # to have no strings, but in fact all prgm chunks in Civ 3 do have strings (at least the first prgm chunks in each file do).
-        self.size = read_amb_int (amb_file)
+        self.size = read_amb_int (buf)
 
         # PRGM chunk number, equals n where this is the n-th PRGM chunk in the file. There is ONE exception to this rule: in ChariotAttack.amb, the
         # 8th PRGM chunk has number 5.
-        self.number = read_amb_int (amb_file)
+        self.number = read_amb_int (buf)
 
         # Observations about dat fields, by index:
         #   0. One of [0, 1, 2, 3]. 3 is the most common
@@ -85,297 +179,673 @@ class Prgm:
         #   4. One of [0, 10, 127, 75, 785]. 75 is the most common.
         #   1 & 2 are upper and lower bounds for randomized playback speed. +/- 100 points corresponds to about +/- 6%.
         #   3 & 4 are upper and lower bounds for randomized volume.
-        self.dat = []
-        for n in range(5):
-            self.dat.append (read_amb_int (amb_file, unsigned = False))
+        if buf.pos + 24 > len (buf.data):
+            raise buf.eof_exception (24)
+        (*self.dat, end_indicator) = struct.unpack_from ("<5iI", buf.data, buf.pos)
+        buf.pos += 24
 
-        if read_amb_int (amb_file) != 0xFA:
-            raise Exception ("Expected (0x FA 00 00 00) before strings in Prgm chunk in \"" + amb_file + "\"")
+        if end_indicator != 0xFA:
+            raise Exception ("Expected (0x FA 00 00 00) before strings in Prgm chunk in \"" + str (buf.file_path) + "\"")
 
-        self.str1 = read_string (amb_file) # effect name
-        self.str2 = read_string (amb_file) # var name
+        # Strings are interned since the same names are repeated in many files
+        self.str1 = sys.intern (read_string (buf)) # effect name
+        self.str2 = sys.intern (read_string (buf)) # var name
 
     def compute_size (self):
-        return 30 + len(self.str1) + len(self.str2) # 7 ints * 4 bytes per + 2 null terminators + length of both strings
+        return 30 + len(self.str1.encode ("utf-8")) + len(self.str2.encode ("utf-8")) # 7 ints * 4 bytes per + 2 null terminators + bytes of both strings
+
+    def describe_line (self):
+        return "\tprgm\t" + "\t".join ([str (d) for d in self.dat]) + "\t'" + self.str1 + "'  '" + self.str2 + "'"
 
     def describe (self):
-        print ("\tprgm\t" + "\t".join ([str (d) for d in self.dat]) + "\t'" + self.str1 + "'  '" + self.str2 + "'")
+        print (self.describe_line ())
 
 class KmapItem:
-    def __init__ (self, amb_file, int2, int6):
+    __slots__ = ("Aint1", "Aint2", "Bdat1", "str1")
+
+    def __init__ (self, buf, int2, int6):
         if (int2 & 6) == 0: # False for all AMBs in Civ 3
-            self.Aint1 = read_amb_int (amb_file)
-            self.Aint2 = read_amb_int (amb_file)
+            self.Aint1 = read_amb_int (buf)
+            self.Aint2 = read_amb_int (buf)
         else:
-            self.Bdat1 = amb_file.read (int6) # Always 0x (7F 00 00 00 00 00 00 00 01 00 00 00)
-        self.str1 = read_string (amb_file)
+            self.Bdat1 = buf.read (int6) # Always 0x (7F 00 00 00 00 00 00 00 01 00 00 00)
+        self.str1 = sys.intern (read_string (buf))
 
     def get_description (self):
         return str (self.Bdat1) + "  '" + self.str1 + "'"
 
 class Kmap:
-    def __init__ (self, amb_file):
-        self.size = read_amb_int (amb_file)
-
-        self.int2 = read_amb_int (amb_file) # flags? Equals 2 for all Kmap chunks in all files
-        self.int3 = read_amb_int (amb_file) # Always zero
-        self.int4 = read_amb_int (amb_file) # Always zero
-        self.str1 = read_string (amb_file)
-        self.int5 = read_amb_int (amb_file) # item count
+    __slots__ = ("size", "int2", "int3", "int4", "str1", "int5", "int6", "items", "__weakref__")
+
+    def __init__ (self, buf):
+        # int2: flags? Equals 2 for all Kmap chunks in all files
+        # int3 & int4: Always zero
+        if buf.pos + 16 > len (buf.data):
+            raise buf.eof_exception (16)
+        (self.size, self.int2, self.int3, self.int4) = struct.unpack_from ("<4I", buf.data, buf.pos)
+        buf.pos += 16
+        self.str1 = sys.intern (read_string (buf))
+        self.int5 = read_amb_int (buf) # item count
 
         if (self.int2 & 6) != 0: # True for all AMBs in Civ 3
-            self.int6 = read_amb_int (amb_file) # Always 12
+            self.int6 = read_amb_int (buf) # Always 12
         else:
             self.int6 = None
 
         # In all Civ 3 AMBs, there are 3 chunks with 0 items and all the rest have 1 item
         self.items = []
         for n in range(self.int5):
-            self.items.append(KmapItem(amb_file, self.int2, self.int6))
+            self.items.append(KmapItem(buf, self.int2, self.int6))
 
-        if read_amb_int (amb_file) != 0xFA:
-            raise Exception ("Expected (0x FA 00 00 00) at end of Kmap chunk in \"" + amb_file + "\"")
+        if read_amb_int (buf) != 0xFA:
+            raise Exception ("Expected (0x FA 00 00 00) at end of Kmap chunk in \"" + str (buf.file_path) + "\"")
 
     def compute_size (self):
-        size = 20 + len(self.str1) + 5 # 5 ints * 4 bytes per + length of str1 + null term. + 4-byte end indicator
+        size = 20 + len(self.str1.encode ("utf-8")) + 5 # 5 ints * 4 bytes per + bytes of str1 + null term. + 4-byte end indicator
+        if self.int6 is None:
+            size -= 4
         for item in self.items:
-            size += 12 + len(item.str1) + 1 # 12 bytes of ??? + length of str 1 + null term.
+            if (self.int2 & 6) != 0:
+                size += len(item.Bdat1) + len(item.str1.encode ("utf-8")) + 1 # 12 bytes of ??? + bytes of str 1 + null term.
+            else:
+                size += 8 + len(item.str1.encode ("utf-8")) + 1
         return size
 
-    def describe (self):
+    def describe_line (self):
         item_descriptions = [i.get_description () for i in self.items]
-        print ("\tkmap\t" + "{}\t{}\t{}\t'{}'\t{}\t{}\t{}".format (self.int2, self.int3, self.int4, self.str1, self.int5, self.int6, str (item_descriptions)))
+        return "\tkmap\t" + "{}\t{}\t{}\t'{}'\t{}\t{}\t{}".format (self.int2, self.int3, self.int4, self.str1, self.int5, self.int6, str (item_descriptions))
+
+    def describe (self):
+        print (self.describe_line ())
 
 class Glbl:
-    def __init__ (self, amb_file):
-        self.size = read_amb_int (amb_file)
-        tell0 = amb_file.tell()
+    __slots__ = ("size", "int2", "dat1", "dat2", "__weakref__")
 
-        self.int2 = read_amb_int (amb_file) # Always 12
-        self.dat1 = amb_file.read (self.int2) # Always 0x (00 00 00 00 00 00 00 00 CD CD CD CD)
+    def __init__ (self, buf):
+        self.size = read_amb_int (buf)
+        tell0 = buf.tell()
+
+        self.int2 = read_amb_int (buf) # Always 12
+        self.dat1 = buf.read (self.int2) # Always 0x (00 00 00 00 00 00 00 00 CD CD CD CD)
 
         # Dump the rest of the chunk into dat2 for now. The decompiled code to read the rest of the chunk is really weird and maybe corrupt.
         # Dat2 is empty for all chunks in all files
-        self.dat2 = amb_file.read (self.size - (amb_file.tell() - tell0))
+        self.dat2 = buf.read (self.size - (buf.tell() - tell0))
+
+    def describe_line (self):
+        return "\tglbl\t" + str (self.int2) + "\t" + str (self.dat1) + "\t" + str (self.dat2)
 
     def describe (self):
-        print ("\tglbl\t" + str (self.int2) + "\t" + str (self.dat1) + "\t" + str (self.dat2))
+        print (self.describe_line ())
+
+# Every MIDI event class has a small integer "kind" code so events can be told apart without comparing types. Meta events are numbered from 1 to 5
+# and channel events use the upper nibble of their status byte. MidiTrackUnknownEvent is 0.
 
 class MidiTrackName:
-    def __init__ (self, midi_file, delta_time):
+    __slots__ = ("delta_time", "name")
+    kind = 1
+
+    def __init__ (self, buf, delta_time):
         self.delta_time = delta_time
-        length = read_midi_var_int (midi_file)
-        self.name = midi_file.read (length).decode ("utf-8")
+        length = read_midi_var_int (buf)
+        if buf.pos + length > len (buf.data):
+            raise buf.eof_exception (length)
+        self.name = sys.intern (str (buf.view[buf.pos:buf.pos + length], "utf-8"))
+        buf.pos += length
+
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tTrackName '{}'".format (timestamp, self.name)
 
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tTrackName '{}'".format (timestamp, self.name))
+        print (self.describe_line (timestamp))
 
 class MidiSMPTEOffset:
-    def __init__ (self, midi_file, delta_time):
+    __slots__ = ("delta_time", "hr", "mn", "se", "fr", "ff")
+    kind = 2
+
+    def __init__ (self, buf, delta_time):
         self.delta_time = delta_time
-        self.hr = int.from_bytes(midi_file.read (1), "big")
-        self.mn = int.from_bytes(midi_file.read (1), "big")
-        self.se = int.from_bytes(midi_file.read (1), "big")
-        self.fr = int.from_bytes(midi_file.read (1), "big")
-        self.ff = int.from_bytes(midi_file.read (1), "big")
+        (self.hr, self.mn, self.se, self.fr, self.ff) = buf.read (5)
 
-    def describe (self, timestamp):
+    def describe_line (self, timestamp):
         contents = " ".join ([str(v) for v in [self.hr, self.mn, self.se, self.fr, self.ff]])
-        print ("\t\t\t{:01.3f}\tSMPTEOffset {}".format (timestamp, contents))
+        return "\t\t\t{:01.3f}\tSMPTEOffset {}".format (timestamp, contents)
+
+    def describe (self, timestamp):
+        print (self.describe_line (timestamp))
 
 class MidiTimeSignature:
-    def __init__ (self, midi_file, delta_time):
+    __slots__ = ("delta_time", "nn", "dd", "cc", "bb")
+    kind = 3
+
+    def __init__ (self, buf, delta_time):
         self.delta_time = delta_time
-        self.nn = int.from_bytes(midi_file.read (1), "big")
-        self.dd = int.from_bytes(midi_file.read (1), "big")
-        self.cc = int.from_bytes(midi_file.read (1), "big")
-        self.bb = int.from_bytes(midi_file.read (1), "big")
+        (self.nn, self.dd, self.cc, self.bb) = buf.read (4)
 
-    def describe (self, timestamp):
+    def describe_line (self, timestamp):
         contents = " ".join ([str(v) for v in [self.nn, self.dd, self.cc, self.bb]])
-        print ("\t\t\t{:01.3f}\tTimeSignature {}".format (timestamp, contents))
+        return "\t\t\t{:01.3f}\tTimeSignature {}".format (timestamp, contents)
+
+    def describe (self, timestamp):
+        print (self.describe_line (timestamp))
 
 class MidiSetTempo:
-    def __init__ (self, midi_file, delta_time):
+    __slots__ = ("delta_time", "microseconds_per_quarter_note")
+    kind = 4
+
+    def __init__ (self, buf, delta_time):
         self.delta_time = delta_time
-        self.microseconds_per_quarter_note = int.from_bytes(midi_file.read (3), "big")
+        self.microseconds_per_quarter_note = int.from_bytes (buf.read (3), "big")
+
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tSetTempo {}".format (timestamp, self.microseconds_per_quarter_note)
 
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tSetTempo {}".format (timestamp, self.microseconds_per_quarter_note))
+        print (self.describe_line (timestamp))
 
 class MidiEndOfTrack:
-    def __init__ (self, midi_file, delta_time):
+    __slots__ = ("delta_time",)
+    kind = 5
+
+    def __init__ (self, buf, delta_time):
         self.delta_time = delta_time
 
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tEndOfTrack".format (timestamp)
+
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tEndOfTrack".format (timestamp))
+        print (self.describe_line (timestamp))
+
+midi_meta_event_kinds = frozenset ([MidiTrackName.kind, MidiSMPTEOffset.kind, MidiTimeSignature.kind, MidiSetTempo.kind, MidiEndOfTrack.kind])
 
 def is_midi_meta_event (event):
-    t = type (event)
-    return (t == MidiTrackName) or (t == MidiSMPTEOffset) or (t == MidiTimeSignature) or (t == MidiSetTempo) or (t == MidiEndOfTrack)
+    return event.kind in midi_meta_event_kinds
 
 class MidiControlChange:
-    def __init__ (self, midi_file, delta_time, event_byte):
+    __slots__ = ("delta_time", "channel_number", "controller_number", "value")
+    kind = 0xB
+
+    def __init__ (self, buf, delta_time, channel_number):
         self.delta_time = delta_time
-        self.channel_number = int.from_bytes (event_byte, "big") & 0xF
-        self.controller_number = int.from_bytes (midi_file.read (1), "big")
+        self.channel_number = channel_number
+        (self.controller_number, self.value) = buf.read (2)
         if self.controller_number >= 122:
             raise Exception ("This is actually a channel mode message")
-        self.value = int.from_bytes (midi_file.read (1), "big")
+
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tControlChange {} {} {}".format (timestamp, self.channel_number, self.controller_number, self.value)
 
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tControlChange {} {} {}".format (timestamp, self.channel_number, self.controller_number, self.value))
+        print (self.describe_line (timestamp))
 
 class MidiProgramChange:
-    def __init__ (self, midi_file, delta_time, event_byte):
+    __slots__ = ("delta_time", "channel_number", "program_number")
+    kind = 0xC
+
+    def __init__ (self, buf, delta_time, channel_number):
         self.delta_time = delta_time
-        self.channel_number = int.from_bytes (event_byte, "big") & 0xF
-        self.program_number = int.from_bytes (midi_file.read (1), "big")
+        self.channel_number = channel_number
+        self.program_number = read_byte (buf)
+
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tProgramChange {} {}".format (timestamp, self.channel_number, self.program_number)
 
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tProgramChange {} {}".format (timestamp, self.channel_number, self.program_number))
+        print (self.describe_line (timestamp))
 
 class MidiNoteOff:
-    def __init__ (self, midi_file, delta_time, event_byte):
+    __slots__ = ("delta_time", "channel_number", "key", "velocity")
+    kind = 0x8
+
+    def __init__ (self, buf, delta_time, channel_number):
         self.delta_time = delta_time
-        self.channel_number = int.from_bytes (event_byte, "big") & 0xF
-        self.key = int.from_bytes (midi_file.read (1), "big")
-        self.velocity = int.from_bytes (midi_file.read (1), "big")
+        self.channel_number = channel_number
+        (self.key, self.velocity) = buf.read (2)
+
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tNoteOff {} {} {}".format (timestamp, self.channel_number, self.key, self.velocity)
 
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tNoteOff {} {} {}".format (timestamp, self.channel_number, self.key, self.velocity))
+        print (self.describe_line (timestamp))
 
 class MidiNoteOn:
-    def __init__ (self, midi_file, delta_time, event_byte):
+    __slots__ = ("delta_time", "channel_number", "key", "velocity")
+    kind = 0x9
+
+    def __init__ (self, buf, delta_time, channel_number):
         self.delta_time = delta_time
-        self.channel_number = int.from_bytes (event_byte, "big") & 0xF
-        self.key = int.from_bytes (midi_file.read (1), "big")
-        self.velocity = int.from_bytes (midi_file.read (1), "big")
+        self.channel_number = channel_number
+        (self.key, self.velocity) = buf.read (2)
+
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tNoteOn {} {} {}".format (timestamp, self.channel_number, self.key, self.velocity)
 
     def describe (self, timestamp):
-        print ("\t\t\t{:01.3f}\tNoteOn {} {} {}".format (timestamp, self.channel_number, self.key, self.velocity))
+        print (self.describe_line (timestamp))
 
 class MidiTrackUnknownEvent:
+    __slots__ = ("delta_time", "sig")
+    kind = 0
+
     def __init__ (self, delta_time, sig):
         self.delta_time = delta_time
         self.sig = sig
 
-def read_midi_track_event (midi_file, prev_event):
-    delta_time = read_midi_var_int (midi_file)
-    byte1 = midi_file.read (1)
-    int_byte1 = int.from_bytes (byte1, "big")
+    def describe_line (self, timestamp):
+        return "\t\t\t{:01.3f}\tUnknown {}".format (timestamp, self.sig.hex (" "))
+
+    def describe (self, timestamp):
+        print (self.describe_line (timestamp))
+
+# Maps meta-event type bytes to the event class and the length byte that must follow the type for us to understand the event
+midi_meta_event_types = {0x2F: (MidiEndOfTrack   , 0x00),
+                         0x51: (MidiSetTempo     , 0x03),
+                         0x54: (MidiSMPTEOffset  , 0x05),
+                         0x58: (MidiTimeSignature, 0x04)}
+
+midi_channel_event_types = {0x8: MidiNoteOff,
+                            0x9: MidiNoteOn,
+                            0xB: MidiControlChange,
+                            0xC: MidiProgramChange}
+
+def read_midi_track_event (buf, prev_event):
+    delta_time = read_midi_var_int (buf)
+    if buf.pos >= len (buf.data):
+        raise Exception ("Unexpected EOF while reading MIDI track event")
+    byte1 = buf.data[buf.pos]
 
     # Implement running status: If the previous event was not a meta-event and the highest bit of the first byte of this event is not set, then this
-    # is event inherits the status byte from the previous one, determining its delta time, event type, and channel number
-    if (prev_event is not None) and (not is_midi_meta_event (prev_event)) and (0 == (int_byte1 & 0x80)):
-        return type (prev_event) (midi_file, prev_event.delta_time, prev_event.channel_number.to_bytes (1, "big"))
-
-    if byte1 == b"\xFF":
-        byte2 = midi_file.read (1)
-        if byte2 == b"\x03":
-            return MidiTrackName (midi_file, delta_time)
-        elif byte2 == b"\x2F":
-            byte3 = midi_file.read (1)
-            if byte3 == b"\x00":
-                return MidiEndOfTrack (midi_file, delta_time)
-            else:
-                return MidiTrackUnknownEvent (delta_time, byte1 + byte2 + byte3)
-        elif byte2 == b"\x51":
-            byte3 = midi_file.read (1)
-            if byte3 == b"\x03":
-                return MidiSetTempo (midi_file, delta_time)
-            else:
-                return MidiTrackUnknownEvent (delta_time, byte1 + byte2 + byte3)
-        elif byte2 == b"\x54":
-            byte3 = midi_file.read (1)
-            if byte3 == b"\x05":
-                return MidiSMPTEOffset (midi_file, delta_time)
-            else:
-                return MidiTrackUnknownEvent (delta_time, byte1 + byte2 + byte3)
-        elif byte2 == b"\x58":
-            byte3 = midi_file.read (1)
-            if byte3 == b"\x04":
-                return MidiTimeSignature (midi_file, delta_time)
+    # is event inherits the status byte from the previous one, determining its event type and channel number. The byte we peeked at is the first
+    # data byte of the event so it's left in the buffer for the event class to read.
+    if (prev_event is not None) and (not is_midi_meta_event (prev_event)) and (0 == (byte1 & 0x80)):
+        return type (prev_event) (buf, delta_time, prev_event.channel_number)
+    buf.pos += 1
+
+    if byte1 == 0xFF:
+        byte2 = read_byte (buf)
+        if byte2 == 0x03:
+            return MidiTrackName (buf, delta_time)
+        elif byte2 in midi_meta_event_types:
+            (event_class, expected_byte3) = midi_meta_event_types[byte2]
+            byte3 = read_byte (buf)
+            if byte3 == expected_byte3:
+                return event_class (buf, delta_time)
             else:
-                return MidiTrackUnknownEvent (delta_time, byte1 + byte2 + byte3)
+                return MidiTrackUnknownEvent (delta_time, bytes ([byte1, byte2, byte3]))
         else:
-            return MidiTrackUnknownEvent (delta_time, byte1 + byte2)
-    elif (int_byte1 >> 4) == 8:
-        return MidiNoteOff (midi_file, delta_time, byte1)
-    elif (int_byte1 >> 4) == 9:
-        return MidiNoteOn (midi_file, delta_time, byte1)
-    elif (int_byte1 >> 4) == 0xB:
-        return MidiControlChange (midi_file, delta_time, byte1)
-    elif (int_byte1 >> 4) == 0xC:
-        return MidiProgramChange (midi_file, delta_time, byte1)
+            return MidiTrackUnknownEvent (delta_time, bytes ([byte1, byte2]))
+    elif (byte1 >> 4) in midi_channel_event_types:
+        return midi_channel_event_types[byte1 >> 4] (buf, delta_time, byte1 & 0xF)
     else:
-        return MidiTrackUnknownEvent (delta_time, byte1)
+        return MidiTrackUnknownEvent (delta_time, bytes ([byte1]))
 
+# Number of data bytes following the status byte of each kind of channel event understood by read_midi_track_event
+midi_channel_event_data_sizes = {0x8: 2, 0x9: 2, 0xB: 2, 0xC: 1}
+
+# Adds up the delta times of the events in a track without creating any event objects. Events are skipped over following the same rules as
+# read_midi_track_event, including running status, and the sum stops after the first event that function wouldn't understand. Every read is
+# bounded by the end of the track and malformed events raise the same exceptions as decoding the track would, so lazy & eager tracks agree.
+def sum_midi_track_delta_times (data, pos, end):
+    tr = 0
+    running_status = None
+    while pos < end:
+        delta_time = data[pos]
+        if delta_time < 0x80: # Inline fast path for single byte delta times
+            pos += 1
+        else:
+            (delta_time, pos) = read_bounded_midi_var_int (data, pos, end)
+        tr += delta_time
+
+        if pos >= end:
+            raise midi_track_overrun_exception (end)
+        status = data[pos]
+        if status == 0xFF:
+            if pos + 2 > end:
+                raise midi_track_overrun_exception (end)
+            meta_type = data[pos + 1]
+            if meta_type == 0x03:
+                (length, pos) = read_bounded_midi_var_int (data, pos + 2, end)
+                if pos + length > end:
+                    raise midi_track_overrun_exception (end)
+                str (data[pos:pos + length], "utf-8") # Only decoded so that invalid names fail here the same as when the track is decoded
+                pos += length
+            elif meta_type in midi_meta_event_types:
+                if pos + 3 > end:
+                    raise midi_track_overrun_exception (end)
+                if data[pos + 2] != midi_meta_event_types[meta_type][1]:
+                    break
+                pos += 3 + data[pos + 2]
+            else:
+                break
+            running_status = None
+        else:
+            if status & 0x80:
+                if (status >> 4) not in midi_channel_event_types:
+                    break
+                running_status = status
+                pos += 1
+            elif running_status is None:
+                break
+            if pos + midi_channel_event_data_sizes[running_status >> 4] > end:
+                raise midi_track_overrun_exception (end)
+            if (running_status >> 4) == MidiControlChange.kind and data[pos] >= 122:
+                raise Exception ("This is actually a channel mode message")
+            pos += midi_channel_event_data_sizes[running_status >> 4]
+        if pos > end:
+            raise midi_track_overrun_exception (end)
+    return tr
+
+# Reads a MIDI variable length quantity from data at pos without going past end, returning (value, position after it)
+def read_bounded_midi_var_int (data, pos, end):
+    tr = 0
+    while pos < end:
+        byte = data[pos]
+        pos += 1
+        tr = (tr << 7) + (byte & 0x7F)
+        if (byte & 0x80) == 0:
+            return (tr, pos)
+    raise Exception ("Unexpected EOF in variable length quantity")
+
+def midi_track_overrun_exception (end):
+    return Exception ("MIDI track event runs past the end of its track at offset " + str (end))
+
+# A track may be loaded lazily, in which case only the location of its event data is recorded and events are decoded from the file contents as
+# they're needed. Either way, iter_events will step through the track's events and "events" holds the complete list, though accessing it for a lazy
+# track decodes and stores the whole thing.
 class MidiTrack:
-    def __init__ (self, midi_file):
-        self.size = read_midi_int (midi_file)
-        events_starting_offset = midi_file.tell ()
-        self.events = []
-        while midi_file.tell () < events_starting_offset + self.size:
-            event = read_midi_track_event (midi_file, self.events[-1] if len (self.events) > 0 else None)
-            self.events.append (event)
+    __slots__ = ("size", "event_list", "unknown_event_offset", "data", "events_offset", "__weakref__")
+
+    def __init__ (self, buf, lazy = False):
+        self.size = read_midi_int (buf)
+        self.events_offset = buf.pos
+        events_ending_offset = buf.pos + self.size
+        if events_ending_offset > len (buf.data):
+            raise Exception ("Unexpected EOF, MIDI track of " + str (self.size) + " bytes at offset " + str (buf.pos) + " runs past end of file")
+        self.unknown_event_offset = None
+        if lazy:
+            self.data = buf.data
+            self.event_list = None
+            buf.pos = events_ending_offset
+            return
+
+        self.data = None
+        self.event_list = []
+        event = None
+        while buf.pos < events_ending_offset:
+            event = read_midi_track_event (buf, event)
+            if buf.pos > events_ending_offset:
+                raise midi_track_overrun_exception (events_ending_offset)
+            self.event_list.append (event)
 
             # If we encountered an unknown event, skip the rest of the track data. This is necessary since we couldn't parse this event.
-            if type (event) == MidiTrackUnknownEvent:
-                self.unknown_event_offset = midi_file.tell ()
-                midi_file.read (events_starting_offset + self.size - midi_file.tell ())
+            if event.kind == MidiTrackUnknownEvent.kind:
+                self.unknown_event_offset = buf.pos
+                buf.pos = events_ending_offset
                 break
 
+    @property
+    def events (self):
+        if self.event_list is None:
+            self.event_list = list (self.iter_events ())
+        return self.event_list
+
+    @events.setter
+    def events (self, events):
+        self.event_list = events
+
+    # Generates the events of the track in order. For a lazy track they're decoded one at a time so the caller can stop early without the rest of
+    # the track ever being read.
+    def iter_events (self):
+        if self.event_list is not None:
+            yield from self.event_list
+            return
+        buf = AmbBuffer (self.data)
+        buf.pos = self.events_offset
+        events_ending_offset = self.events_offset + self.size
+        event = None
+        while buf.pos < events_ending_offset:
+            event = read_midi_track_event (buf, event)
+            if buf.pos > events_ending_offset:
+                raise midi_track_overrun_exception (events_ending_offset)
+            if event.kind == MidiTrackUnknownEvent.kind:
+                self.unknown_event_offset = buf.pos
+                yield event
+                return
+            yield event
+
     def length (self):
-        return sum ([e.delta_time for e in self.events])
+        if self.event_list is None:
+            return sum_midi_track_delta_times (self.data, self.events_offset, self.events_offset + self.size)
+        return sum ([e.delta_time for e in self.event_list])
 
+    # Track names always appear among the meta events at the start of a track so stop looking once we reach the first non-meta event
     def get_name (self):
-        for event in self.events:
-            if type (event) == MidiTrackName:
+        for event in self.iter_events ():
+            if event.kind == MidiTrackName.kind:
                 return event.name
+            elif not is_midi_meta_event (event):
+                break
         return None
 
-    def describe (self, seconds_per_tick):
-        print ("\t\tTrack:")
+    # Generates the lines printed by describe. If timestamps is given it must hold the time in seconds of each event, otherwise the times are worked
+    # out from the delta times and seconds_per_tick.
+    def describe_lines (self, seconds_per_tick, timestamps = None):
+        yield "\t\tTrack:"
+        if timestamps is not None:
+            for (e, timestamp) in zip (self.iter_events (), timestamps):
+                yield e.describe_line (timestamp)
+            return
         timestamp = 0
-        for e in self.events:
+        for e in self.iter_events ():
             timestamp += e.delta_time * seconds_per_tick
-            e.describe (timestamp)
+            yield e.describe_line (timestamp)
+
+    # Prints the track's events with their times
+    def describe (self, seconds_per_tick, timestamps = None):
+        for line in self.describe_lines (seconds_per_tick, timestamps):
+            print (line)
+
+# All events of a Midi merged into a single stream sorted by time, with the absolute time of each event in ticks and seconds stored in arrays so that
+# the events in a time range can be found with a binary search. Events at the same tick are ordered by track then by position in the track. Also
+# records, for every track, the times of its events in seconds, and for every effect (i.e. track name), the time of its first NoteOn and last NoteOff.
+class MidiTimeline:
+    def __init__ (self, midi):
+        seconds_per_tick = midi.seconds_per_quarter_note / midi.ticks_per_quarter_note
+        self.ticks = array.array ("q")
+        self.seconds = array.array ("d")
+        self.track_indices = array.array ("H")
+        self.events = []
+        self.track_seconds = [array.array ("d") for t in midi.tracks]
+        self.effect_spans = {} # Maps case-folded effect names to (start seconds, end seconds)
+
+        # The per-track times in seconds are accumulated the same way MidiTrack.describe always has so its output doesn't change. The merged times are
+        # computed directly from the ticks so they're guaranteed to be in order.
+        def track_events (track_index, track):
+            tick = 0
+            seconds = 0
+            for (event_index, event) in enumerate (track.iter_events ()):
+                tick += event.delta_time
+                seconds += event.delta_time * seconds_per_tick
+                yield (tick, track_index, event_index, seconds, event)
+
+        # Each track's name (found the same way as MidiTrack.get_name), first NoteOn time, and last NoteOn or NoteOff time are picked up during the
+        # merge so the tracks are only decoded once
+        track_count = len (midi.tracks)
+        names = [None] * track_count
+        names_closed = [False] * track_count
+        first_note_on_times = [None] * track_count
+        last_note_times = [None] * track_count
+        for (tick, track_index, _, seconds, event) in heapq.merge (*[track_events (n, t) for (n, t) in enumerate (midi.tracks)]):
+            self.ticks.append (tick)
+            self.seconds.append (tick * seconds_per_tick)
+            self.track_indices.append (track_index)
+            self.events.append (event)
+            self.track_seconds[track_index].append (seconds)
+
+            kind = event.kind
+            if kind == MidiNoteOn.kind:
+                if first_note_on_times[track_index] is None:
+                    first_note_on_times[track_index] = seconds
+                last_note_times[track_index] = seconds
+            elif kind == MidiNoteOff.kind:
+                last_note_times[track_index] = seconds
+            elif kind == MidiTrackName.kind and not names_closed[track_index]:
+                names[track_index] = event.name
+                names_closed[track_index] = True
+            if kind not in midi_meta_event_kinds:
+                names_closed[track_index] = True
+
+        for track_index in range (1, track_count): # Skip first track which has metadata
+            name = names[track_index]
+            if name is None or first_note_on_times[track_index] is None:
+                continue
+            first = first_note_on_times[track_index]
+            (start, end) = self.effect_spans.get (name.casefold (), (first, first))
+            self.effect_spans[name.casefold ()] = (min (start, first), max (end, last_note_times[track_index]))
+
+    def __len__ (self):
+        return len (self.events)
+
+    # Returns the events with times in seconds in the range [start, end) as a list of (seconds, track index, event)
+    def events_between (self, start, end):
+        first = bisect.bisect_left (self.seconds, start)
+        last = bisect.bisect_left (self.seconds, end, first)
+        return [(self.seconds[n], self.track_indices[n], self.events[n]) for n in range (first, last)]
+
+    # Returns (start, end) in seconds for the effect with the given name, or None if no track plays it
+    def effect_span (self, effect_name):
+        return self.effect_spans.get (effect_name.casefold ())
 
 class Midi:
-    def __init__ (self, midi_file):
-        header_size = read_midi_int (midi_file)
+    def __init__ (self, buf, lazy_tracks = False, intern_table = None):
+        header_size = read_midi_int (buf)
         if header_size != 6:
             raise Exception ("Unexpected MIDI header size: " + str (header_size))
-        midi_format = read_midi_short (midi_file)
+        midi_format = read_midi_short (buf)
         if midi_format != 1:
             raise Exception ("Unexpected MIDI format: " + str (midi_format))
-        track_count = read_midi_short (midi_file)
-        division_info = read_midi_short (midi_file)
+        track_count = read_midi_short (buf)
+        division_info = read_midi_short (buf)
         if (division_info >> 15) != 0:
             raise Exception ("Unexpected MIDI division format in: " + hex (division_info))
         self.ticks_per_quarter_note = division_info # Always 480
         self.tracks = []
         for n in range (track_count):
-            tag = midi_file.read (4)
+            tag = buf.read (4)
             if tag == b"MTrk":
-                self.tracks.append (MidiTrack (midi_file))
-            elif tag == b"":
-                raise Exception ("Unexpected EOF while reading tracks")
+                if intern_table is not None:
+                    self.tracks.append (intern_table.read_track (buf, lazy_tracks))
+                else:
+                    self.tracks.append (MidiTrack (buf, lazy_tracks))
             else:
-                raise Exception ("Unexpected chunk tag " + tag + " encountered while reading tracks")
+                raise Exception ("Unexpected chunk tag " + str (tag) + " encountered while reading tracks")
 
         # Read tempo info from SetTempo meta-event in first track
-        set_tempos = [e for e in self.tracks[0].events if type (e) == MidiSetTempo]
+        set_tempos = [e for e in self.tracks[0].iter_events () if e.kind == MidiSetTempo.kind]
         if len (set_tempos) != 1:
             raise Exception ("Expected exactly one SetTempo event in first track of file")
         self.seconds_per_quarter_note = set_tempos[0].microseconds_per_quarter_note / 1000000
+        self.timeline = None
+
+    # Returns the MidiTimeline for this Midi, compiling it the first time it's needed
+    def get_timeline (self):
+        if self.timeline is None:
+            self.timeline = MidiTimeline (self)
+        return self.timeline
+
+    # The times of each track's events are summed up as the track is described, which is cheaper than compiling the timeline, but if the timeline
+    # was already compiled its times are reused. They're accumulated the same way so the output is identical either way.
+    def describe_lines (self):
+        yield "\tMidi:"
+        yield "\t\tticks per quarter note: " + str (self.ticks_per_quarter_note)
+        seconds_per_tick = self.seconds_per_quarter_note / self.ticks_per_quarter_note
+        for (n, t) in enumerate (self.tracks):
+            yield from t.describe_lines (seconds_per_tick, self.timeline.track_seconds[n] if self.timeline is not None else None)
+
+    def describe (self):
+        for line in self.describe_lines ():
+            print (line)
+
+# One entry in the table of contents of an AMB file produced by scan_toc. offset is the position of the chunk's tag and size is the value of its size
+# field, which excludes the tag and the size field itself. If names were read, name is the effect name for PRGMs, the var name for KMAPs, or the
+# track name for MTrks, and name2 is the var name for PRGMs.
+class TocEntry:
+    __slots__ = ("tag", "offset", "size", "name", "name2")
+
+    def __init__ (self, tag, offset, size, name = None, name2 = None):
+        self.tag = tag
+        self.offset = offset
+        self.size = size
+        self.name = name
+        self.name2 = name2
 
     def describe (self):
-        print ("\tMidi:")
-        print ("\t\tticks per quarter note: " + str (self.ticks_per_quarter_note))
-        for t in self.tracks:
-            t.describe (self.seconds_per_quarter_note / self.ticks_per_quarter_note)
+        names = "\t'" + self.name + "'" if self.name is not None else ""
+        names += "  '" + self.name2 + "'" if self.name2 is not None else ""
+        print ("\t{}\t{}\t{}{}".format (self.tag, self.offset, self.size, names))
+
+amb_chunk_tags = (b"prgm", b"kmap", b"glbl", b"MThd")
+
+# Returns whether a chunk ending at pos is followed by another chunk or by exactly the end of the file, i.e. whether pos looks like a valid end for
+# a chunk according to its size field. A size pointing past the end of the file doesn't count.
+def is_amb_chunk_end (data, pos):
+    return pos == len (data) or data[pos:pos + 4] in amb_chunk_tags
+
+# Lists the chunks in an AMB file without decoding their contents, using the size fields to jump from one chunk header to the next. With
+# read_names, the effect & var names of PRGM and KMAP chunks and the names of MIDI tracks are read as well but nothing else is. This is much cheaper
+# than a full Amb parse and is meant for taking inventory of many files at once. As with Amb, the file's contents can be passed in as "data".
+def scan_toc (path, read_names = False, data = None):
+    if data is None:
+        with open (path, "rb") as amb_file:
+            data = amb_file.read ()
+    buf = AmbBuffer (data, path)
+    tr = []
+    while buf.pos < len (data):
+        offset = buf.pos
+        tag = buf.read (4)
+        if tag == b"prgm" or tag == b"glbl":
+            size = read_amb_int (buf)
+            entry = TocEntry (tag.decode (), offset, size)
+            if read_names and tag == b"prgm":
+                buf.pos = offset + 36 # Skip tag, size, number, dat, and end indicator
+                entry.name = read_string (buf)
+                entry.name2 = read_string (buf)
+            buf.pos = offset + 8 + size
+        elif tag == b"kmap":
+            size = read_amb_int (buf)
+            entry = TocEntry (tag.decode (), offset, size)
+            if read_names:
+                buf.pos = offset + 20 # Skip tag, size, and int2 through int4
+                entry.name = read_string (buf)
+            buf.pos = offset + 8 + size
+
+            # Some KMAP chunks have size fields that don't match their contents (see ChunkSizeCheck). If the size doesn't lead to another chunk,
+            # decode the KMAP to find out where it really ends.
+            if not is_amb_chunk_end (data, buf.pos):
+                buf.pos = offset + 4
+                Kmap (buf)
+        elif tag == b"MThd":
+            size = read_midi_int (buf)
+            buf.pos += 2 # Skip format
+            track_count = read_midi_short (buf)
+            tr.append (TocEntry (tag.decode (), offset, size))
+            buf.pos = offset + 8 + size
+            for n in range (track_count):
+                track_offset = buf.pos
+                if buf.read (4) != b"MTrk":
+                    raise Exception ("Expected MTrk chunk at offset " + str (track_offset))
+                if read_names:
+                    track = MidiTrack (buf, lazy = True)
+                    tr.append (TocEntry ("MTrk", track_offset, track.size, track.get_name ()))
+                else:
+                    size = read_midi_int (buf)
+                    tr.append (TocEntry ("MTrk", track_offset, size))
+                    buf.pos += size
+            continue
+        else:
+            raise Exception ("Invalid chunk tag " + str (tag) + " at offset " + str (offset))
+        tr.append (entry)
+    return tr
 
 #
 # Misc facts about AMB files:
@@ -385,72 +855,708 @@ class Midi:
 #
 
 class Amb:
-    def __init__ (self, file_path):
+    # The file is read in a single call then parsed out of memory. Alternatively the raw contents can be passed in as "data", in which case file_path
+    # is only used for reference. With lazy_tracks, MIDI track events are only decoded when they're needed (see MidiTrack). If an AmbInternTable is
+    # given, chunks and tracks are shared with other AMBs loaded through the same table that have identical contents.
+    def __init__ (self, file_path, data = None, lazy_tracks = False, intern_table = None):
         self.file_path = file_path
-        with open (file_path, "rb") as amb_file:
-            self.chunks = []
-            self.midi = None
-            while True:
-                tag = amb_file.read (4)
+        if data is None:
+            with open (file_path, "rb") as amb_file:
+                data = amb_file.read ()
+        if intern_table is not None:
+            file_key = hash_amb_contents (data)
+            if intern_table.share_file (self, file_key):
+                return
+        buf = AmbBuffer (data, file_path)
+        self.chunks = []
+        self.midi = None
+        try:
+            while buf.pos < len (data):
+                tag = buf.read (4)
                 if tag == b"prgm":
-                    self.chunks.append (Prgm (amb_file))
+                    self.chunks.append (Prgm (buf) if intern_table is None else intern_table.read_chunk (Prgm, buf))
                 elif tag == b"kmap":
-                    self.chunks.append (Kmap (amb_file))
+                    self.chunks.append (Kmap (buf) if intern_table is None else intern_table.read_chunk (Kmap, buf))
                 elif tag == b"glbl":
-                    self.chunks.append (Glbl (amb_file))
+                    self.chunks.append (Glbl (buf) if intern_table is None else intern_table.read_chunk (Glbl, buf))
                 elif tag == b"MThd":
                     if self.midi == None:
-                        self.midi = Midi (amb_file)
+                        self.midi = Midi (buf, lazy_tracks, intern_table)
                     else:
                         raise Exception ("File contains multiple MIDI headers")
-                elif tag == b"":
-                    break # EOF
                 else:
-                    raise Exception ("Invalid chunk tag " + str(tag) + " at offset " + str(amb_file.tell() - 4))
-
-    def describe (self):
+                    raise Exception ("Invalid chunk tag " + str(tag) + " at offset " + str(buf.pos - 4))
+        except Exception as e:
+            # Remember how far into the file we got so that load failures can be reported with a location
+            if not hasattr (e, "amb_offset"):
+                e.amb_offset = buf.pos
+            raise
+        if intern_table is not None:
+            intern_table.add_file (self, file_key)
+
+    def describe_lines (self):
         (_, file_name) = os.path.split (self.file_path)
-        print (file_name + ":")
+        yield file_name + ":"
         for c in self.chunks:
-            c.describe ()
-        self.midi.describe ()
-
-all_amb_paths = []
-for art_path in civ3_unit_art_paths:
-    for unit_name in os.listdir(art_path):
-        unit_folder = os.path.join (art_path, unit_name)
-        if os.path.isdir (unit_folder):
-            for file_name in os.listdir(unit_folder):
-                if file_name.endswith (".amb") or file_name.endswith (".AMB"):
-                    all_amb_paths.append (os.path.join (unit_folder, file_name))
-
-print ("Found " + str (len (all_amb_paths)) + " AMB files")
-
-ambs = {}
-success_count = 0
-for amb_path in all_amb_paths:
-    try:
-        amb = Amb (amb_path)
-        ambs[amb_path] = amb
-        success_count += 1
-    except Exception as e:
-        print ("Failed to load AMB from \"" + amb_path + "\": " + str (e))
+            yield c.describe_line ()
+        yield from self.midi.describe_lines ()
 
-print ("Successfully loaded " + str (success_count) + " of " + str (len (all_amb_paths)) + " files")
+    def describe (self):
+        for line in self.describe_lines ():
+            print (line)
+
+# Version number of the parsed AMB format stored by AmbDiskCache. Bump this whenever a change to the parser affects the contents of Amb objects so
+# that caches written by older versions are thrown out instead of returning outdated objects.
+amb_cache_format_version = 4
+
+# Stores parsed AMBs on disk so unchanged files don't need to be parsed again in the next session. The whole cache is kept in one pack file that
+# maps each AMB path to its size, modification time, optionally a hash of its contents, and the pickled Amb. Loading the pack only reads the pickled
+# bytes, each Amb is unpickled the first time it's asked for. Entries whose file has changed are counted as stale and reparsed. Call save to write
+# new entries back to disk.
+class AmbDiskCache:
+    def __init__ (self, cache_dir, use_content_hash = False):
+        self.cache_dir = cache_dir
+        self.pack_path = os.path.join (cache_dir, "amb_cache.pickle")
+        self.use_content_hash = use_content_hash
+        self.entries = {}
+        self.dirty = False
+        self.hit_count = 0
+        self.miss_count = 0
+        self.stale_count = 0
+        try:
+            with open (self.pack_path, "rb") as pack_file:
+                (version, entries) = pickle.load (pack_file)
+            if version == amb_cache_format_version:
+                self.entries = entries
+            else:
+                self.dirty = True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print ("Ignoring unreadable AMB cache \"" + self.pack_path + "\": " + str (e))
+            self.dirty = True
+
+    def load (self, amb_path):
+        stat = os.stat (amb_path)
+        entry = self.entries.get (amb_path)
+        data = None
+        if entry is not None:
+            (size, mtime_ns, content_hash, pickled_amb) = entry
+            if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                if not self.use_content_hash:
+                    self.hit_count += 1
+                    return pickle.loads (pickled_amb)
+                with open (amb_path, "rb") as amb_file:
+                    data = amb_file.read ()
+                if content_hash == hash_amb_contents (data):
+                    self.hit_count += 1
+                    return pickle.loads (pickled_amb)
+            self.stale_count += 1
+        else:
+            self.miss_count += 1
+
+        if data is None:
+            with open (amb_path, "rb") as amb_file:
+                data = amb_file.read ()
+        amb = Amb (amb_path, data)
+        content_hash = hash_amb_contents (data) if self.use_content_hash else None
+        self.entries[amb_path] = (stat.st_size, stat.st_mtime_ns, content_hash, pickle.dumps (amb, protocol = pickle.HIGHEST_PROTOCOL))
+        self.dirty = True
+        return amb
+
+    # Drops entries for files that are not in amb_paths, e.g. because they were deleted
+    def prune (self, amb_paths):
+        keep = set (amb_paths)
+        for path in [p for p in self.entries if p not in keep]:
+            del self.entries[path]
+            self.dirty = True
+
+    def save (self):
+        if not self.dirty:
+            return
+        os.makedirs (self.cache_dir, exist_ok = True)
+        temp_path = self.pack_path + ".tmp"
+        with open (temp_path, "wb") as pack_file:
+            pickle.dump ((amb_cache_format_version, self.entries), pack_file, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace (temp_path, self.pack_path)
+        self.dirty = False
+
+    def stats (self):
+        return {"entries": len (self.entries), "hits": self.hit_count, "misses": self.miss_count, "stale": self.stale_count}
+
+def hash_amb_contents (data):
+    return hashlib.blake2b (data, digest_size = 16).digest ()
+
+# Shares parsed objects between AMBs with identical contents, which there are many of since the vanilla, PTW, and Conquests art directories
+# repeat many units and many sounds reuse the same PRGM & KMAP chunks and tracks. Chunks and tracks are looked up by a hash of their raw bytes
+# (including tag and size) before being parsed, and if one with the same bytes was already loaded, the existing object is reused and the bytes are
+# skipped. Whole files are handled the same way, so a duplicate file gets a new Amb with its own file_path but the chunk list and Midi of the
+# first copy. Objects are held by weak references so the table never keeps anything in memory on its own, e.g. after an AmbCatalog evicts it.
+# Since objects may be shared, Ambs loaded through a table must not be modified. Load a separate copy to edit instead, like edit_amb_files does.
+class AmbInternTable:
+    def __init__ (self):
+        self.files = weakref.WeakValueDictionary ()
+        self.parts = weakref.WeakValueDictionary ()
+        self.file_hit_count = 0
+        self.hit_count = 0
+        self.miss_count = 0
+
+    # If an AMB whose contents hash to file_key (see hash_amb_contents) is loaded, fills in amb with its chunks & Midi and returns True
+    def share_file (self, amb, file_key):
+        original = self.files.get (file_key)
+        if original is None:
+            return False
+        amb.chunks = original.chunks
+        amb.midi = original.midi
+        self.file_hit_count += 1
+        return True
+
+    def add_file (self, amb, file_key):
+        self.files[file_key] = amb
+
+    # Reads a PRGM, KMAP, or GLBL chunk whose tag has just been read. Only chunks whose size fields lead to the start of the next chunk are shared,
+    # since otherwise we can't tell where the chunk ends without parsing it (see ChunkSizeCheck).
+    def read_chunk (self, chunk_class, buf):
+        start = buf.pos - 4
+        if buf.pos + 4 > len (buf.data):
+            raise buf.eof_exception (4)
+        (size,) = amb_uint_struct.unpack_from (buf.data, buf.pos)
+        end = buf.pos + 4 + size
+        if not is_amb_chunk_end (buf.data, end):
+            return chunk_class (buf)
+        key = hash_amb_contents (buf.view[start:end])
+        chunk = self.parts.get (key)
+        if chunk is not None and type (chunk) == chunk_class:
+            self.hit_count += 1
+            buf.pos = end
+            return chunk
+        self.miss_count += 1
+        chunk = chunk_class (buf)
+        if buf.pos == end:
+            self.parts[key] = chunk
+        return chunk
+
+    # Reads a MIDI track whose MTrk tag has just been read
+    def read_track (self, buf, lazy):
+        start = buf.pos - 4
+        if buf.pos + 4 > len (buf.data):
+            raise buf.eof_exception (4)
+        (size,) = midi_uint_struct.unpack_from (buf.data, buf.pos)
+        end = buf.pos + 4 + size
+        key = hash_amb_contents (buf.view[start:end])
+        track = self.parts.get (key)
+        if track is not None and type (track) == MidiTrack:
+            self.hit_count += 1
+            buf.pos = end
+            return track
+        self.miss_count += 1
+        track = MidiTrack (buf, lazy)
+        self.parts[key] = track
+        return track
+
+    def stats (self):
+        return {"files": len (self.files), "parts": len (self.parts), "file_hits": self.file_hit_count, "hits": self.hit_count,
+                "misses": self.miss_count}
+
+# Returns the paths of all AMB files inside the unit folders of the given art directories. Art directories that don't exist are skipped, e.g. on
+# installs without PTW or Conquests.
+def list_amb_paths (art_paths):
+    return list (scan_amb_files (art_paths))
+
+# Like list_amb_paths except returns a dict mapping each AMB path to its (size, modification time in ns). Uses os.scandir so the directory listing
+# and file info come from the same walk instead of one os.stat call per entry where the OS allows it.
+def scan_amb_files (art_paths):
+    tr = {}
+    for art_path in art_paths:
+        if not os.path.isdir (art_path):
+            continue
+        with os.scandir (art_path) as unit_entries:
+            unit_folders = [e.path for e in unit_entries if e.is_dir ()]
+        for unit_folder in unit_folders:
+            with os.scandir (unit_folder) as file_entries:
+                for e in file_entries:
+                    if e.name.endswith (".amb") or e.name.endswith (".AMB"):
+                        stat = e.stat ()
+                        tr[e.path] = (stat.st_size, stat.st_mtime_ns)
+    return tr
+
+# The result of AmbCatalog.refresh, lists the paths of AMB files that appeared, changed, or disappeared since the previous scan
+class AmbCatalogChanges:
+    def __init__ (self, added, modified, removed):
+        self.added = added
+        self.modified = modified
+        self.removed = removed
+
+    def __bool__ (self):
+        return len (self.added) + len (self.modified) + len (self.removed) > 0
+
+    def describe (self):
+        if not self:
+            print ("No changes")
+            return
+        for (label, paths) in [("Added", self.added), ("Modified", self.modified), ("Removed", self.removed)]:
+            for path in paths:
+                print (label + ": " + path)
+
+# Results of find_duplicates. file_groups is a list of lists of paths of files with identical contents, largest groups first. part_counts maps
+# each chunk tag (with "MTrk" for MIDI tracks) to (total count, number of distinct contents).
+class DuplicateReport:
+    def __init__ (self, file_count, file_groups, part_counts):
+        self.file_count = file_count
+        self.file_groups = file_groups
+        self.part_counts = part_counts
+
+    def describe (self, group_limit = 20):
+        duplicate_count = sum ([len (g) - 1 for g in self.file_groups])
+        print ("{} files, {} are duplicates of another in {} groups".format (self.file_count, duplicate_count, len (self.file_groups)))
+        for (tag, (total, distinct)) in self.part_counts.items ():
+            print ("{}: {} total, {} distinct".format (tag, total, distinct))
+        for group in self.file_groups[:group_limit]:
+            print ("{} copies:".format (len (group)))
+            for path in group:
+                print ("  " + path)
+        if len (self.file_groups) > group_limit:
+            print ("... and {} more groups".format (len (self.file_groups) - group_limit))
+
+# Finds AMBs in paths (the whole catalog by default) that are byte-identical and counts how many of their chunks and tracks are. Chunks are
+# located with scan_toc so nothing is parsed. A chunk runs up to the start of the next one, so KMAPs with wrong size fields are still compared whole.
+def find_duplicates (paths = None):
+    if paths is None:
+        paths = all_amb_paths
+    files = collections.defaultdict (list)
+    part_totals = collections.Counter ()
+    part_hashes = collections.defaultdict (set)
+    file_count = 0
+    for path in paths:
+        try:
+            with open (path, "rb") as amb_file:
+                data = amb_file.read ()
+            toc = scan_toc (path, data = data)
+        except Exception:
+            continue
+        file_count += 1
+        files[hash_amb_contents (data)].append (path)
+        ends = [e.offset for e in toc[1:]] + [len (data)]
+        for (entry, end) in zip (toc, ends):
+            if entry.tag != "MThd":
+                part_totals[entry.tag] += 1
+                part_hashes[entry.tag].add (hash_amb_contents (data[entry.offset:end]))
+    part_counts = {tag: (part_totals[tag], len (part_hashes[tag])) for tag in ["prgm", "kmap", "glbl", "MTrk"] if tag in part_totals}
+    file_groups = sorted ([g for g in files.values () if len (g) > 1], key = len, reverse = True)
+    return DuplicateReport (file_count, file_groups, part_counts)
+
+# Indexes all AMB files under a set of art directories without parsing any of them. An AMB is parsed the first time it's requested then kept in an
+# LRU cache holding at most cache_size of them, so memory use stays bounded no matter how large the install is. The catalog can be used like a
+# read-only dict mapping file paths to Amb objects. Files that fail to load are reported once and skipped when iterating over the catalog. If an
+# AmbDiskCache is given, AMBs are loaded through it instead of always being parsed from scratch. If an AmbInternTable is given, AMBs that are parsed
+# share objects with identical contents through it. The size and modification time of every file is remembered so that refresh can pick up files
+# that were added, edited, or deleted since without starting over.
+class AmbCatalog:
+    def __init__ (self, art_paths, cache_size = 1024, disk_cache = None, intern_table = None):
+        self.art_paths = art_paths
+        self.cache_size = cache_size
+        self.disk_cache = disk_cache
+        self.intern_table = intern_table
+        self.snapshot = scan_amb_files (art_paths) # Maps each path to (size, mtime_ns) as of the last scan
+        self.paths = list (self.snapshot)
+        self.path_set = set (self.paths)
+        self.cache = collections.OrderedDict ()
+        self.failures = {} # Maps paths of files that couldn't be loaded to the error message
+
+    def __len__ (self):
+        return len (self.paths)
+
+    def __contains__ (self, path):
+        return path in self.path_set
+
+    def __iter__ (self):
+        return iter (self.paths)
+
+    def keys (self):
+        return list (self.paths)
+
+    def load (self, path):
+        if self.disk_cache is not None:
+            return self.disk_cache.load (path)
+        return Amb (path, intern_table = self.intern_table)
+
+    def __getitem__ (self, path):
+        amb = self.cache.get (path)
+        if amb is not None:
+            self.cache.move_to_end (path)
+            return amb
+        if path not in self.path_set:
+            raise KeyError (path)
+        amb = self.load (path)
+        self.cache[path] = amb
+        if len (self.cache) > self.cache_size:
+            self.cache.popitem (last = False)
+        return amb
+
+    # Like __getitem__ except returns None if the file can't be loaded
+    def get (self, path):
+        if path in self.failures:
+            return None
+        try:
+            return self[path]
+        except KeyError:
+            return None
+        except Exception as e:
+            self.failures[path] = str (e)
+            print ("Failed to load AMB from \"" + path + "\": " + str (e))
+            return None
+
+    def items (self):
+        for path in self.paths:
+            amb = self.get (path)
+            if amb is not None:
+                yield (path, amb)
+
+    def values (self):
+        for (path, amb) in self.items ():
+            yield amb
+
+    def find (self, pattern):
+        matches = [k for k in self.paths if pattern in k]
+        if len (matches) == 0:
+            raise Exception("No match")
+        elif len (matches) > 1:
+            raise Exception("Pattern is ambiguous. Matches: " + str (matches))
+        else:
+            return self[matches[0]]
+
+    # Rescans the art directories and compares them against the previous scan by path, size, and modification time. Removed and modified files are
+    # dropped from the cache so they're parsed again the next time they're requested, or right away if reparse is True. Unchanged files are left
+    # alone, so a refresh when nothing has changed costs only the directory walk. The paths list is updated in place so references to it held
+    # elsewhere, like all_amb_paths, stay current. Returns an AmbCatalogChanges.
+    def refresh (self, reparse = False):
+        snapshot = scan_amb_files (self.art_paths)
+        old_snapshot = self.snapshot
+        added    = [p for p in snapshot if p not in old_snapshot]
+        modified = [p for p in snapshot if p in old_snapshot and snapshot[p] != old_snapshot[p]]
+        removed  = [p for p in old_snapshot if p not in snapshot]
+        changes = AmbCatalogChanges (added, modified, removed)
+        if not changes:
+            return changes
+
+        for path in modified + removed:
+            self.cache.pop (path, None)
+        for path in added + modified + removed:
+            self.failures.pop (path, None)
+        self.snapshot = snapshot
+        self.paths[:] = snapshot.keys ()
+        self.path_set = set (self.paths)
+        if self.disk_cache is not None and len (removed) > 0:
+            self.disk_cache.prune (self.paths)
+
+        if reparse:
+            for path in added + modified:
+                self.get (path)
+        return changes
+
+    # Polls the art directories every interval seconds and applies any changes to the catalog. callback is called with the AmbCatalogChanges
+    # whenever something changed, by default they're printed. Runs until interrupted with Ctrl+C or until stop_event (a threading.Event) is set. To
+    # keep the catalog current while using the interpreter, run this in a background thread, e.g.:
+    #   threading.Thread (target = ambs.watch, kwargs = {"stop_event": stop}, daemon = True).start ()
+    def watch (self, interval = 2.0, callback = None, reparse = True, stop_event = None):
+        try:
+            while stop_event is None or not stop_event.is_set ():
+                changes = self.refresh (reparse)
+                if changes:
+                    if callback is not None:
+                        callback (changes)
+                    else:
+                        changes.describe ()
+                if stop_event is not None:
+                    stop_event.wait (interval)
+                else:
+                    time.sleep (interval)
+        except KeyboardInterrupt:
+            pass
+
+# Records an AMB that couldn't be loaded. offset is the position in the file where parsing stopped, or None if the file couldn't be read at all.
+class AmbLoadFailure:
+    def __init__ (self, path, exception_type, message, offset):
+        self.path = path
+        self.exception_type = exception_type
+        self.message = message
+        self.offset = offset
+
+    def describe (self, file = None):
+        location = " at offset " + str (self.offset) if self.offset is not None else ""
+        print ("Failed to load AMB from \"" + self.path + "\"" + location + ": " + self.exception_type + ": " + self.message, file = file)
+
+# Loads a list of AMBs, returning a list of (path, Amb or None, AmbLoadFailure or None). This is the unit of work handed to each process in
+# load_corpus, so it must stay a module-level function for the process pool to be able to pickle it. Like the catalog, the AMBs of a batch only
+# share identical objects if share_identical_ambs is set.
+def load_amb_batch (paths):
+    tr = []
+    intern_table = AmbInternTable () if share_identical_ambs else None
+    for path in paths:
+        try:
+            tr.append ((path, Amb (path, intern_table = intern_table), None))
+        except Exception as e:
+            tr.append ((path, None, make_amb_load_failure (path, e)))
+    return tr
+
+def make_amb_load_failure (path, exception):
+    return AmbLoadFailure (path, type (exception).__name__, str (exception), getattr (exception, "amb_offset", None))
+
+# Applies function to batches of items, spreading the batches over a pool of "jobs" processes (all CPUs by default, or in this process if jobs == 1).
+# Items are handed out in batches so that the per-task overhead of sending work to another process is not paid for every item. function must be
+# defined at module level so it can be pickled, it's called with a list of items and its results are generated in the same order as the batches.
+def map_in_batches (function, items, jobs = None, batch_size = None):
+    items = list (items)
+    if jobs is None:
+        jobs = os.cpu_count () or 1
+    if batch_size is None:
+        batch_size = max (1, min (64, len (items) // (jobs * 4)))
+    batches = [items[n:n + batch_size] for n in range (0, len (items), batch_size)]
+
+    if jobs <= 1 or len (batches) <= 1:
+        yield from map (function, batches)
+        return
+    with concurrent.futures.ProcessPoolExecutor (max_workers = jobs) as executor:
+        yield from executor.map (function, batches)
+
+# Parses all AMBs in paths, spreading the work over a pool of "jobs" processes using map_in_batches. Returns a dict mapping paths to Amb objects plus
+# a list of AmbLoadFailures, both in the same order as paths regardless of how the work was scheduled.
+# Every Amb is pickled in its worker and unpickled here, and unpickling a batch takes nearly as long as parsing it did, so this doesn't get much
+# faster than about 1.2x no matter how many processes are used. To go through the whole corpus quickly, do the per-file work in the workers
+# instead and send back only its results, the way export_to_sqlite, check_round_trip, and the validate command do.
+def load_corpus (paths, jobs = None, batch_size = None):
+    loaded = {}
+    failures = []
+    for batch in map_in_batches (load_amb_batch, paths, jobs, batch_size):
+        for (path, amb, failure) in batch:
+            if amb is not None:
+                loaded[path] = amb
+            else:
+                failures.append (failure)
+    return (loaded, failures)
+
+# Records where time goes while AMBs are loaded: time spent parsing each type of chunk (with MThd including the whole embedded MIDI), the number of
+# events read of each class, calls to the read_* helper functions & AmbBuffer.read, time spent scanning art directories, and the bytes, helper calls,
+# and time of every file loaded. Helper calls are not all the reads done while parsing, since the PRGM & KMAP fields and much of the MIDI data are
+# read inline with struct.unpack_from and memoryview slices, but they show how much of the work still goes through the helpers. While enabled, the
+# profiler replaces those functions & constructors with wrappers that record each call, and disable puts the originals back, so there's no cost at all
+# when it's off. The wrappers themselves add some overhead to the times they measure, so compare times between profiled runs only, and use
+# profile_amb_files to get a cProfile dump of an unwrapped run as well.
+class AmbProfiler:
+    def __init__ (self):
+        self.replaced = [] # List of (class or module dict, name, original value)
+        self.reset ()
+
+    def reset (self):
+        self.chunk_counts = collections.Counter ()
+        self.chunk_seconds = collections.Counter ()
+        self.event_counts = collections.Counter ()
+        self.helper_call_count = 0
+        self.scan_count = 0
+        self.scan_seconds = 0
+        self.files = [] # List of (path, byte count, helper call count, seconds)
+
+    def is_enabled (self):
+        return len (self.replaced) > 0
+
+    def replace (self, owner, name, make_wrapper):
+        if type (owner) == dict:
+            original = owner[name]
+            owner[name] = make_wrapper (original)
+        else:
+            original = owner.__dict__[name]
+            setattr (owner, name, make_wrapper (original))
+        self.replaced.append ((owner, name, original))
+
+    def enable (self):
+        if self.is_enabled ():
+            return
+        profiler = self
+        module = globals ()
+
+        def timed_chunk_init (tag):
+            def make_wrapper (original):
+                def wrapper (chunk, *args, **kwargs):
+                    start_time = time.perf_counter ()
+                    try:
+                        original (chunk, *args, **kwargs)
+                    finally:
+                        profiler.chunk_seconds[tag] += time.perf_counter () - start_time
+                        profiler.chunk_counts[tag] += 1
+                return wrapper
+            return make_wrapper
+        for (chunk_class, tag) in [(Prgm, "prgm"), (Kmap, "kmap"), (Glbl, "glbl"), (Midi, "MThd")]:
+            self.replace (chunk_class, "__init__", timed_chunk_init (tag))
+
+        def counted_read (original):
+            def wrapper (*args):
+                profiler.helper_call_count += 1
+                return original (*args)
+            return wrapper
+        for name in ["read_string", "read_byte", "read_amb_int", "read_midi_int", "read_midi_short", "read_midi_var_int"]:
+            self.replace (module, name, counted_read)
+        self.replace (AmbBuffer, "read", counted_read)
+
+        def counted_event_read (original):
+            def wrapper (buf, prev_event):
+                event = original (buf, prev_event)
+                profiler.event_counts[type (event).__name__] += 1
+                return event
+            return wrapper
+        self.replace (module, "read_midi_track_event", counted_event_read)
+
+        def timed_scan (original):
+            def wrapper (art_paths):
+                start_time = time.perf_counter ()
+                try:
+                    return original (art_paths)
+                finally:
+                    profiler.scan_seconds += time.perf_counter () - start_time
+                    profiler.scan_count += 1
+            return wrapper
+        self.replace (module, "scan_amb_files", timed_scan)
+
+        def timed_amb_init (original):
+            def wrapper (amb, file_path, data = None, *args, **kwargs):
+                start_time = time.perf_counter ()
+                helper_call_count = profiler.helper_call_count
+                byte_count = None
+                try:
+                    if data is None:
+                        with open (file_path, "rb") as amb_file:
+                            data = amb_file.read ()
+                    byte_count = len (data)
+                    original (amb, file_path, data, *args, **kwargs)
+                finally:
+                    profiler.files.append ((file_path, byte_count, profiler.helper_call_count - helper_call_count,
+                                            time.perf_counter () - start_time))
+            return wrapper
+        self.replace (Amb, "__init__", timed_amb_init)
+
+    def disable (self):
+        for (owner, name, original) in reversed (self.replaced):
+            if type (owner) == dict:
+                owner[name] = original
+            else:
+                setattr (owner, name, original)
+        self.replaced = []
+
+    # Returns the recorded numbers as a dict ready to be written as JSON, including the slowest_count files that took longest to load
+    def get_report (self, slowest_count = 10):
+        return {"files": {"count": len (self.files),
+                          "bytes": sum ([f[1] or 0 for f in self.files]),
+                          "helper_calls": sum ([f[2] for f in self.files]),
+                          "seconds": sum ([f[3] for f in self.files])},
+                "directory_scans": {"count": self.scan_count, "seconds": self.scan_seconds},
+                "chunks": {tag: {"count": self.chunk_counts[tag], "seconds": self.chunk_seconds[tag]} for tag in self.chunk_counts},
+                "events": dict (self.event_counts),
+                "total_helper_calls": self.helper_call_count,
+                "slowest_files": [{"path": path, "bytes": byte_count, "helper_calls": helper_call_count, "seconds": seconds}
+                                  for (path, byte_count, helper_call_count, seconds) in heapq.nlargest (slowest_count, self.files,
+                                                                                                        key = lambda f: f[3])]}
+
+    def write_report (self, path, slowest_count = 10):
+        with open (path, "w") as report_file:
+            json.dump (self.get_report (slowest_count), report_file, indent = 2)
+
+    def describe (self, slowest_count = 10):
+        report = self.get_report (slowest_count)
+        files = report["files"]
+        print ("Loaded {} files ({} bytes, {} read helper calls) in {:.3f} s".format (files["count"], files["bytes"], files["helper_calls"],
+                                                                                      files["seconds"]))
+        print ("Scanned art directories {} times in {:.3f} s".format (self.scan_count, self.scan_seconds))
+        for (tag, chunk) in report["chunks"].items ():
+            print ("\t{}\t{} chunks\t{:.3f} s\t{:.1f} us per chunk".format (tag, chunk["count"], chunk["seconds"],
+                                                                            1e6 * chunk["seconds"] / chunk["count"]))
+        for (name, count) in self.event_counts.most_common ():
+            print ("\t{}\t{}".format (name, count))
+        print ("Slowest files:")
+        for f in report["slowest_files"]:
+            print ("\t{:.2f} ms\t{}".format (1000 * f["seconds"], f["path"]))
+
+amb_profiler = AmbProfiler ()
+
+# Loads every AMB in paths (all AMBs in the catalog by default) with the profiler enabled, prints its findings, and optionally writes them to
+# report_path as JSON. If pstats_path is given, the files are then loaded again under cProfile with the profiler off and the stats are dumped there
+# for use with pstats or a viewer like snakeviz. Returns the AmbProfiler.
+def profile_amb_files (paths = None, report_path = None, pstats_path = None, slowest_count = 10):
+    profiler = AmbProfiler ()
+    profiler.enable ()
+    try:
+        if paths is None:
+            paths = list (all_amb_paths)
+        for path in paths:
+            try:
+                Amb (path)
+            except Exception:
+                pass
+    finally:
+        profiler.disable ()
+    profiler.describe (slowest_count)
+    if report_path is not None:
+        profiler.write_report (report_path, slowest_count)
+
+    if pstats_path is not None:
+        stats_profile = cProfile.Profile ()
+        stats_profile.enable ()
+        for path in paths:
+            try:
+                Amb (path)
+            except Exception:
+                pass
+        stats_profile.disable ()
+        stats_profile.dump_stats (pstats_path)
+    return profiler
+
+if profile_amb_loading:
+    amb_profiler.enable ()
+
+if amb_cache_dir is not None:
+    amb_disk_cache = AmbDiskCache (amb_cache_dir)
+    atexit.register (amb_disk_cache.save)
+else:
+    amb_disk_cache = None
+
+amb_intern_table = AmbInternTable () if share_identical_ambs else None
+
+# When the script is run with arguments it works as a command line tool (see main), which sets up the catalog from its own arguments instead of
+# civ3_root_dir. Worker processes started on platforms that spawn them (i.e. Windows) reimport the script as "__mp_main__" and don't need it either.
+run_as_command = __name__ == "__main__" and len (sys.argv) > 1
+if run_as_command or __name__ == "__mp_main__":
+    ambs = None
+    all_amb_paths = []
+else:
+    ambs = AmbCatalog (civ3_unit_art_paths, disk_cache = amb_disk_cache, intern_table = amb_intern_table)
+    all_amb_paths = ambs.paths
+    print ("Found " + str (len (all_amb_paths)) + " AMB files")
+
+# Parses every file in paths (all AMBs by default) several times and reports the best time, to get a rough measure of parser performance
+def benchmark_amb_loading (paths = None, repeat = 3):
+    if paths is None:
+        paths = all_amb_paths
+    byte_count = sum ([os.path.getsize (p) for p in paths])
+    best_time = None
+    for n in range (repeat):
+        start_time = time.perf_counter ()
+        for amb_path in paths:
+            try:
+                Amb (amb_path)
+            except Exception:
+                pass
+        elapsed = time.perf_counter () - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    print ("Loaded {} files ({} bytes) in {:.3f} s: {:.0f} files/s, {:.2f} MB/s".format (len (paths), byte_count, best_time, len (paths) / best_time,
+                                                                                      byte_count / best_time / 1e6))
+    return best_time
 
 def find_amb (pattern):
-    matches = [k for k in ambs.keys () if pattern in k]
-    if len (matches) == 0:
-        raise Exception("No match")
-    elif len (matches) > 1:
-        raise Exception("Pattern is ambiguous. Matches: " + str (matches))
-    else:
-        return ambs[matches[0]]
+    return ambs.find (pattern)
 
 def list_all_chunks_of_type (chunk_class):
     tr = []
     for a in ambs.values ():
-        tr += [x for x in a.chunks if type (x) == chunk_class]
+        tr += [x for x in a.chunks if x.__class__ is chunk_class]
     return tr
 
 def list_all_midi_tracks ():
@@ -463,9 +1569,308 @@ def list_all_unknown_midi_track_events ():
     tr = []
     for amb in ambs.values ():
         for track in amb.midi.tracks:
-            tr += [e for e in track.events if type (e) == MidiTrackUnknownEvent]
+            if track.unknown_event_offset is not None: # Reading stops at the first unknown event so it's always the last one in the track
+                tr.append (track.events[-1])
+    return tr
+
+midi_event_table_dtype = [("track"  , "u4"), # Index into MidiEventTable.track_names
+                          ("kind"   , "u1"), # Event class's kind code
+                          ("channel", "u1"),
+                          ("data1"  , "u1"), # Key, controller number, or program number
+                          ("data2"  , "u1"), # Velocity or controller value
+                          ("delta"  , "u4"), # Delta time in ticks
+                          ("tick"   , "u8")] # Absolute time in ticks from the start of the track
+
+def get_midi_event_data (event):
+    kind = event.kind
+    if kind == MidiNoteOn.kind or kind == MidiNoteOff.kind:
+        return (event.channel_number, event.key, event.velocity)
+    elif kind == MidiControlChange.kind:
+        return (event.channel_number, event.controller_number, event.value)
+    elif kind == MidiProgramChange.kind:
+        return (event.channel_number, event.program_number, 0)
+    else:
+        return (0, 0, 0)
+
+# Columnar copy of the events of many MIDI tracks stored in a single NumPy structured array (see midi_event_table_dtype), one row per event, which
+# is more than an order of magnitude smaller than the equivalent event objects and lets corpus-wide queries run as vectorized NumPy operations.
+# Rows are grouped by track in order. Per-track info is kept in parallel lists indexed by track number: the file each track came from, its name,
+# and its seconds per tick. Meta events other than track names are kept on the side as (track, tick, event) tuples. Requires NumPy.
+class MidiEventTable:
+    # sources is an iterable of (file path, Midi) pairs
+    def __init__ (self, sources):
+        if numpy is None:
+            raise Exception ("MidiEventTable requires NumPy")
+        self.track_paths = []
+        self.track_names = []
+        self.meta_events = []
+        seconds_per_tick = []
+        rows = []
+        for (path, midi) in sources:
+            midi_seconds_per_tick = midi.seconds_per_quarter_note / midi.ticks_per_quarter_note
+            for track in midi.tracks:
+                track_index = len (self.track_paths)
+                self.track_paths.append (path)
+                self.track_names.append (track.get_name ())
+                seconds_per_tick.append (midi_seconds_per_tick)
+                tick = 0
+                for event in track.events:
+                    tick += event.delta_time
+                    if is_midi_meta_event (event) and event.kind != MidiTrackName.kind:
+                        self.meta_events.append ((track_index, tick, event))
+                    rows.append ((track_index, event.kind) + get_midi_event_data (event) + (event.delta_time, tick))
+        self.events = numpy.array (rows, dtype = midi_event_table_dtype)
+        self.track_seconds_per_tick = numpy.array (seconds_per_tick, dtype = "f8")
+        self.track_starts = numpy.searchsorted (self.events["track"], numpy.arange (len (self.track_names) + 1))
+
+    def __len__ (self):
+        return len (self.events)
+
+    def track_events (self, track_index):
+        return self.events[self.track_starts[track_index]:self.track_starts[track_index + 1]]
+
+    def of_kind (self, event_class):
+        return self.events[self.events["kind"] == event_class.kind]
+
+    def note_on_keys (self, channel = None):
+        mask = self.events["kind"] == MidiNoteOn.kind
+        if channel is not None:
+            mask &= self.events["channel"] == channel
+        return self.events["data1"][mask]
+
+    # Equivalent to MidiTrack.length for every track at once
+    def track_lengths (self):
+        return numpy.bincount (self.events["track"], weights = self.events["delta"], minlength = len (self.track_names)).astype ("u8")
+
+    def track_durations (self):
+        return self.track_lengths () * self.track_seconds_per_tick
+
+# Builds a MidiEventTable covering every AMB in the catalog
+def build_midi_event_table (catalog = None):
+    if catalog is None:
+        catalog = ambs
+    return MidiEventTable ([(path, amb.midi) for (path, amb) in catalog.items ()])
+
+# Inverted index over the names used in a set of AMBs, built in a single pass so that questions like "which AMBs use this wave file" don't need a
+# rescan of every file. All lookups are case-insensitive. The index maps:
+#   effect names (Prgm.str1) -> list of (AMB path, Prgm, indices of MIDI tracks named after the effect)
+#   var names (Prgm.str2 & Kmap.str1) -> list of (AMB path, Prgms using the var, Kmaps defining it)
+#   wave file names (KmapItem.str1) -> list of AMB paths
+#   unit folder names -> list of AMB paths
+# PRGMs whose effect isn't played by any track and KMAPs whose var isn't used by any PRGM are collected while building the index.
+class AmbIndex:
+    def __init__ (self, amb_items):
+        self.effects = {}
+        self.vars = {}
+        self.waves = {}
+        self.units = {}
+        self.unreferenced_prgms = [] # List of (AMB path, Prgm)
+        self.unreferenced_kmaps = [] # List of (AMB path, Kmap)
+        self.sorted_keys = {}
+        for (path, amb) in amb_items:
+            self.add (path, amb)
+
+    def add (self, path, amb):
+        unit_name = os.path.basename (os.path.dirname (path)).casefold ()
+        self.units.setdefault (unit_name, []).append (path)
+
+        tracks_by_name = {}
+        for (n, track) in enumerate (amb.midi.tracks[1:], 1): # Skip first track which has metadata
+            name = track.get_name ()
+            if name is not None:
+                tracks_by_name.setdefault (name.casefold (), []).append (n)
+
+        prgms_by_var = {}
+        kmaps_by_var = {}
+        for chunk in amb.chunks:
+            if chunk.__class__ is Prgm:
+                track_indices = tracks_by_name.get (chunk.str1.casefold (), [])
+                self.effects.setdefault (chunk.str1.casefold (), []).append ((path, chunk, track_indices))
+                if len (track_indices) == 0:
+                    self.unreferenced_prgms.append ((path, chunk))
+                prgms_by_var.setdefault (chunk.str2, []).append (chunk)
+            elif chunk.__class__ is Kmap:
+                kmaps_by_var.setdefault (chunk.str1, []).append (chunk)
+                for item in chunk.items:
+                    paths = self.waves.setdefault (item.str1.casefold (), [])
+                    if len (paths) == 0 or paths[-1] != path:
+                        paths.append (path)
+
+        # PRGMs are matched to KMAPs by exact var name, the same as KmapReferenceCheck & compile_amb_voices do, so a file with var names that differ
+        # only in case gets an entry for each of them under the same key
+        for var_name in set (prgms_by_var) | set (kmaps_by_var):
+            kmaps = kmaps_by_var.get (var_name, [])
+            self.vars.setdefault (var_name.casefold (), []).append ((path, prgms_by_var.get (var_name, []), kmaps))
+            if var_name not in prgms_by_var:
+                self.unreferenced_kmaps += [(path, kmap) for kmap in kmaps]
+        self.sorted_keys = {}
+
+    def lookup_effect (self, name):
+        return self.effects.get (name.casefold (), [])
+
+    def lookup_var (self, name):
+        return self.vars.get (name.casefold (), [])
+
+    def ambs_using_wave (self, name):
+        return self.waves.get (name.casefold (), [])
+
+    def ambs_in_unit (self, name):
+        return self.units.get (name.casefold (), [])
+
+    # Returns all keys of one of the mappings ("effects", "vars", "waves", or "units") that start with prefix. Uses a binary search over the sorted
+    # keys, which are computed the first time they're needed.
+    def search_prefix (self, mapping_name, prefix):
+        keys = self.sorted_keys.get (mapping_name)
+        if keys is None:
+            keys = sorted (getattr (self, mapping_name))
+            self.sorted_keys[mapping_name] = keys
+        prefix = prefix.casefold ()
+        tr = []
+        n = bisect.bisect_left (keys, prefix)
+        while n < len (keys) and keys[n].startswith (prefix):
+            tr.append (keys[n])
+            n += 1
+        return tr
+
+    # Returns all keys of one of the mappings that contain text
+    def search_substring (self, mapping_name, text):
+        text = text.casefold ()
+        return [k for k in getattr (self, mapping_name) if text in k]
+
+def build_amb_index (catalog = None):
+    if catalog is None:
+        catalog = ambs
+    return AmbIndex (catalog.items ())
+
+# Returns the set of strings describing an AMB that AmbSimilarityIndex compares: the wave files it plays, its effect & var names, the randomization
+# ranges of its PRGMs, and the timing of its NoteOn events. Times are rounded to time_resolution seconds and dat values to steps of 25 so that
+# AMBs that differ only slightly still share features. Timing features are each NoteOn time plus each pair of consecutive gaps between NoteOns, so
+# the same rhythm shifted in time still matches partly.
+def get_amb_similarity_features (amb, time_resolution = 0.05):
+    tr = set ()
+    for chunk in amb.chunks:
+        if chunk.__class__ is Prgm:
+            tr.add ("effect:" + chunk.str1.casefold ())
+            tr.add ("var:" + chunk.str2.casefold ())
+            tr.add ("dat:" + ",".join ([str (round (d / 25)) for d in chunk.dat]))
+        elif chunk.__class__ is Kmap:
+            for item in chunk.items:
+                tr.add ("wave:" + item.str1.casefold ())
+    # NoteOn times are worked out from a running sum of ticks in each track rather than with the MidiTimeline so that indexing the catalog doesn't
+    # leave a compiled timeline on every Amb
+    midi = amb.midi
+    seconds_per_tick = midi.seconds_per_quarter_note / midi.ticks_per_quarter_note
+    note_on_ticks = []
+    for track in midi.tracks:
+        tick = 0
+        for e in track.iter_events ():
+            tick += e.delta_time
+            if e.kind == MidiNoteOn.kind:
+                note_on_ticks.append (tick)
+    note_on_times = [round (tick * seconds_per_tick / time_resolution) for tick in sorted (note_on_ticks)]
+    gaps = [b - a for (a, b) in zip (note_on_times, note_on_times[1:])]
+    tr.update (["time:" + str (t) for t in note_on_times])
+    tr.update (["gaps:" + str (a) + "," + str (b) for (a, b) in zip (gaps, gaps[1:])])
     return tr
 
+similarity_hash_prime = (1 << 61) - 1
+
+# Finds AMBs that are alike without comparing every pair. Each AMB is reduced to a MinHash signature of its features (see
+# get_amb_similarity_features): for each of signature_size random hash functions, the smallest hash of any feature. The fraction of positions where
+# two signatures agree estimates the Jaccard similarity of the feature sets. Signatures are split into bands and AMBs whose signatures match in all
+# positions of any band land in the same bucket, so similar AMBs can be found by looking only at the buckets of a given one. With the default 16
+# bands of 4, pairs with similarity 0.5 share a bucket about 65% of the time, pairs at 0.8 over 99% of the time, and pairs at 0.2 under 3%.
+class AmbSimilarityIndex:
+    def __init__ (self, amb_items, signature_size = 64, band_count = 16, time_resolution = 0.05, seed = 0):
+        if signature_size % band_count != 0:
+            raise Exception ("signature_size must be a multiple of band_count")
+        self.band_count = band_count
+        self.band_size = signature_size // band_count
+        self.time_resolution = time_resolution
+        rng = random.Random (seed)
+        self.hash_params = [(rng.randrange (1, similarity_hash_prime), rng.randrange (0, similarity_hash_prime)) for n in range (signature_size)]
+        self.signatures = {} # Maps AMB paths to signatures
+        self.buckets = {}    # Maps (band number, signature values in band) to lists of AMB paths
+        for (path, amb) in amb_items:
+            self.add (path, amb)
+
+    def get_signature (self, amb):
+        hashes = [int.from_bytes (hashlib.blake2b (f.encode ("utf-8"), digest_size = 8).digest (), "little")
+                  for f in get_amb_similarity_features (amb, self.time_resolution)]
+        if len (hashes) == 0:
+            return tuple ([similarity_hash_prime] * len (self.hash_params))
+        return tuple ([min ([(a * h + b) % similarity_hash_prime for h in hashes]) for (a, b) in self.hash_params])
+
+    def get_bucket_keys (self, signature):
+        return [(n, signature[n * self.band_size:(n + 1) * self.band_size]) for n in range (self.band_count)]
+
+    def add (self, path, amb):
+        signature = self.get_signature (amb)
+        self.signatures[path] = signature
+        for key in self.get_bucket_keys (signature):
+            self.buckets.setdefault (key, []).append (path)
+
+    def similarity (self, path_a, path_b):
+        return self.compare_signatures (self.signatures[path_a], self.signatures[path_b])
+
+    def compare_signatures (self, a, b):
+        return sum ([1 for (x, y) in zip (a, b) if x == y]) / len (a)
+
+    # Returns the paths of AMBs that share at least one bucket with the given signature
+    def get_candidates (self, signature):
+        tr = set ()
+        for key in self.get_bucket_keys (signature):
+            tr.update (self.buckets.get (key, []))
+        return tr
+
+    # Returns up to k of the AMBs most similar to target as a list of (estimated similarity, path), most similar first. target may be the path of
+    # an AMB in the index or an Amb object. Only AMBs sharing a bucket with target are considered, so ones with low similarity may be missed.
+    def most_similar (self, target, k = 10):
+        if type (target) == str:
+            signature = self.signatures[target]
+            target_path = target
+        else:
+            signature = self.get_signature (target)
+            target_path = target.file_path
+        scored = [(self.compare_signatures (signature, self.signatures[p]), p) for p in self.get_candidates (signature) if p != target_path]
+        return heapq.nlargest (k, scored)
+
+    # Groups AMBs into clusters where each one has an estimated similarity of at least threshold to another in the same cluster. Only pairs that
+    # share a bucket are compared. Returns a list of clusters, each a sorted list of paths, largest first. AMBs that aren't similar to any other are
+    # left out.
+    def find_clusters (self, threshold = 0.5):
+        parents = {}
+        def find_root (path):
+            while parents.get (path, path) != path:
+                path = parents[path]
+            return path
+
+        compared = set ()
+        for paths in self.buckets.values ():
+            for (n, a) in enumerate (paths):
+                for b in paths[n + 1:]:
+                    pair = (a, b) if a < b else (b, a)
+                    if pair in compared:
+                        continue
+                    compared.add (pair)
+                    if self.similarity (a, b) >= threshold:
+                        (root_a, root_b) = (find_root (a), find_root (b))
+                        if root_a != root_b:
+                            parents[root_b] = root_a
+
+        clusters = {}
+        for path in parents:
+            clusters.setdefault (find_root (path), []).append (path)
+        for (root, members) in clusters.items ():
+            if root not in parents:
+                members.append (root)
+        return sorted ([sorted (c) for c in clusters.values ()], key = len, reverse = True)
+
+def build_similarity_index (catalog = None, signature_size = 64, band_count = 16):
+    if catalog is None:
+        catalog = ambs
+    return AmbSimilarityIndex (catalog.items (), signature_size, band_count)
+
 def histogram(vals):
     tr = {}
     for v in vals:
@@ -475,115 +1880,1360 @@ def histogram(vals):
             tr[v] = 1
     return tr
 
-def investigate_format ():
-    empty_kmap_count = 0
-    one_item_kmap_count = 0
-    multiple_items_kmap_count = 0
-    for kmap in list_all_chunks_of_type (Kmap):
-        if len (kmap.items) == 0:
-            empty_kmap_count += 1
-        elif len (kmap.items) == 1:
-            one_item_kmap_count += 1
-        else:
-            multiple_items_kmap_count += 1
-
-    print ("No. of KMap chunks with no items: " + str (empty_kmap_count))
-    print ("No. of KMap chunks with one item: " + str (one_item_kmap_count))
-    print ("No. of KMap chunks with two or more items: " + str (multiple_items_kmap_count))
-
-    all_sound_tracks_have_names = True
-    unmatched_effect_name_count = 0
-    any_ambiguous_effect_names = False
-    for a in ambs.values ():
-        for track in a.midi.tracks[1:]: # Skip first track which has metadata
-            effect_name = track.get_name ()
+# Information about one AMB that's commonly needed by corpus checks, worked out once per file so that each check doesn't have to recompute it
+class AmbCheckInfo:
+    def __init__ (self, path, amb):
+        self.path = path
+        self.amb = amb
+        self.prgms = [c for c in amb.chunks if c.__class__ is Prgm]
+        self.kmaps = [c for c in amb.chunks if c.__class__ is Kmap]
+        self.sound_tracks = amb.midi.tracks[1:] # Skip first track which has metadata
+        self.sound_track_names = [t.get_name () for t in self.sound_tracks]
+
+        # Maps case-folded effect names to the number of PRGMs and tracks with that name, and var names to the number of PRGMs using them
+        self.prgm_counts_by_effect = histogram ([p.str1.casefold () for p in self.prgms])
+        self.track_counts_by_effect = histogram ([n.casefold () for n in self.sound_track_names if n is not None])
+        self.prgm_counts_by_var = histogram ([p.str2 for p in self.prgms])
+
+# Base class for checks run over the whole corpus by run_corpus_checks. Every AMB is passed to visit once, then report returns the results as a list
+# of (label, value) pairs. A value may be a list of items, e.g. the names of chunks failing the check. To add a check, subclass this and decorate it
+# with register_corpus_check. When the corpus is split over several processes by check_amb_files, each process visits part of it with its own
+# instance of the check and merge combines them, so checks run that way must also implement merge.
+class CorpusCheck:
+    def visit (self, info):
+        pass
+
+    # Adds the results of other, an instance of the same class that visited a different set of AMBs, into this one
+    def merge (self, other):
+        raise Exception (type (self).__name__ + " can't be merged")
+
+    def report (self):
+        return []
+
+corpus_checks = []
+
+def register_corpus_check (check_class):
+    corpus_checks.append (check_class)
+    return check_class
+
+@register_corpus_check
+class KmapItemCountCheck (CorpusCheck):
+    def __init__ (self):
+        self.counts = [0, 0, 0] # No. of KMAPs with zero, one, and two or more items
+
+    def visit (self, info):
+        for kmap in info.kmaps:
+            self.counts[min (len (kmap.items), 2)] += 1
+
+    def merge (self, other):
+        self.counts = [a + b for (a, b) in zip (self.counts, other.counts)]
+
+    def report (self):
+        return [("No. of KMap chunks with no items", self.counts[0]),
+                ("No. of KMap chunks with one item", self.counts[1]),
+                ("No. of KMap chunks with two or more items", self.counts[2])]
+
+@register_corpus_check
+class TrackEffectNameCheck (CorpusCheck):
+    def __init__ (self):
+        self.all_sound_tracks_have_names = True
+        self.unmatched_effect_name_count = 0
+        self.any_ambiguous_effect_names = False
+
+    def visit (self, info):
+        for effect_name in info.sound_track_names:
             if effect_name is not None and effect_name != "":
-                matching_prgm_count = len([x for x in a.chunks if type (x) == Prgm and x.str1.casefold () == effect_name.casefold ()])
+                matching_prgm_count = info.prgm_counts_by_effect.get (effect_name.casefold (), 0)
                 if matching_prgm_count == 0:
-                    unmatched_effect_name_count += 1
+                    self.unmatched_effect_name_count += 1
                 elif matching_prgm_count > 1:
-                    any_ambiguous_effect_names = True
+                    self.any_ambiguous_effect_names = True
             else:
-                all_sound_tracks_have_names = False
+                self.all_sound_tracks_have_names = False
+
+    def merge (self, other):
+        self.all_sound_tracks_have_names = self.all_sound_tracks_have_names and other.all_sound_tracks_have_names
+        self.unmatched_effect_name_count += other.unmatched_effect_name_count
+        self.any_ambiguous_effect_names = self.any_ambiguous_effect_names or other.any_ambiguous_effect_names
+
+    def report (self):
+        return [("All MIDI sound tracks have non-empty names", self.all_sound_tracks_have_names),
+                ("No. of MIDI track names that don't match any PRGM effect names", self.unmatched_effect_name_count),
+                ("Any MIDI track names match multiple PRGM effect names", self.any_ambiguous_effect_names)]
+
+@register_corpus_check
+class PrgmReferenceCheck (CorpusCheck):
+    def __init__ (self):
+        self.unreferenced_prgm_chunk_count = 0
+        self.multi_referenced_prgm_chunk_count = 0
+
+    def visit (self, info):
+        for prgm in info.prgms:
+            ref_count = info.track_counts_by_effect.get (prgm.str1.casefold (), 0)
+            if ref_count == 0:
+                self.unreferenced_prgm_chunk_count += 1
+            elif ref_count > 1:
+                self.multi_referenced_prgm_chunk_count += 1
+
+    def merge (self, other):
+        self.unreferenced_prgm_chunk_count += other.unreferenced_prgm_chunk_count
+        self.multi_referenced_prgm_chunk_count += other.multi_referenced_prgm_chunk_count
+
+    def report (self):
+        return [("No. of PRGM chunks with effect names not referenced by any track", self.unreferenced_prgm_chunk_count),
+                ("No. of PRGM chunks with effect names referenced by two or more tracks", self.multi_referenced_prgm_chunk_count)]
+
+@register_corpus_check
+class KmapReferenceCheck (CorpusCheck):
+    def __init__ (self):
+        self.unreferenced_kmaps = []
+        self.multi_referenced_kmap_chunk_count = 0
+
+    def visit (self, info):
+        for kmap in info.kmaps:
+            ref_count = info.prgm_counts_by_var.get (kmap.str1, 0)
+            if ref_count == 0:
+                self.unreferenced_kmaps.append (f"{kmap.str1} in {info.path}")
+            elif ref_count > 1:
+                self.multi_referenced_kmap_chunk_count += 1
+
+    def merge (self, other):
+        self.unreferenced_kmaps += other.unreferenced_kmaps
+        self.multi_referenced_kmap_chunk_count += other.multi_referenced_kmap_chunk_count
+
+    def report (self):
+        return [("No. of KMAP chunks with var names not referenced by any PRGM", len (self.unreferenced_kmaps)),
+                ("No. of KMAP chunks with var names referenced by two or more PRGMs", self.multi_referenced_kmap_chunk_count)]
+
+@register_corpus_check
+class WaveFileNameCheck (CorpusCheck):
+    def __init__ (self):
+        self.any_wave_files_contain_slashes = False
+
+    def visit (self, info):
+        for kmap in info.kmaps:
+            for item in kmap.items:
+                if '/' in item.str1 or '\\' in item.str1:
+                    self.any_wave_files_contain_slashes = True
+
+    def merge (self, other):
+        self.any_wave_files_contain_slashes = self.any_wave_files_contain_slashes or other.any_wave_files_contain_slashes
+
+    def report (self):
+        return [("Any slashes appear in any wave file names", self.any_wave_files_contain_slashes)]
+
+@register_corpus_check
+class MaxCountsCheck (CorpusCheck):
+    def __init__ (self):
+        self.most_prgms = 0
+        self.most_kmaps = 0
+        self.most_tracks = 0
+        self.most_events = 0
+
+    def visit (self, info):
+        self.most_prgms  = max (self.most_prgms , len (info.prgms))
+        self.most_kmaps  = max (self.most_kmaps , len (info.kmaps))
+        self.most_tracks = max (self.most_tracks, len (info.amb.midi.tracks))
+        self.most_events = max ([self.most_events] + [len (t.events) for t in info.amb.midi.tracks])
+
+    def merge (self, other):
+        self.most_prgms  = max (self.most_prgms , other.most_prgms )
+        self.most_kmaps  = max (self.most_kmaps , other.most_kmaps )
+        self.most_tracks = max (self.most_tracks, other.most_tracks)
+        self.most_events = max (self.most_events, other.most_events)
+
+    def report (self):
+        return [("Most PRGM chunks in any file" , self.most_prgms),
+                ("Most KMAP chunks in any file" , self.most_kmaps),
+                ("Most Midi tracks in any file" , self.most_tracks),
+                ("Most events in any Midi track", self.most_events)]
+
+@register_corpus_check
+class ZeroTimeBeforeNoteOnCheck (CorpusCheck):
+    def __init__ (self):
+        self.all_times_zero_before_note_on = True
+
+    def visit (self, info):
+        for track in info.sound_tracks:
+            for event in track.iter_events ():
+                if event.kind == MidiNoteOn.kind:
+                    break
+                if event.delta_time != 0:
+                    self.all_times_zero_before_note_on = False
+
+    def merge (self, other):
+        self.all_times_zero_before_note_on = self.all_times_zero_before_note_on and other.all_times_zero_before_note_on
+
+    def report (self):
+        return [("All event times zero before NoteOn", self.all_times_zero_before_note_on)]
+
+@register_corpus_check
+class ChunkSizeCheck (CorpusCheck):
+    def __init__ (self):
+        self.unexpected_prgm_size_count = 0
+        self.unexpected_size_kmaps = []
+
+    def visit (self, info):
+        for prgm in info.prgms:
+            if prgm.size != prgm.compute_size ():
+                self.unexpected_prgm_size_count += 1
+        for kmap in info.kmaps:
+            if kmap.size != kmap.compute_size ():
+                self.unexpected_size_kmaps.append (f"{kmap.str1} in {info.path}")
+
+    def merge (self, other):
+        self.unexpected_prgm_size_count += other.unexpected_prgm_size_count
+        self.unexpected_size_kmaps += other.unexpected_size_kmaps
+
+    def report (self):
+        return [("No. of PRGM chunks with unexpected sizes", self.unexpected_prgm_size_count),
+                ("No. of KMAP chunks with unexpected sizes", self.unexpected_size_kmaps)]
+
+# Results of run_corpus_checks. "results" is a list of (check class name, label, value) in the order the checks were run.
+class CorpusReport:
+    def __init__ (self, results, file_count):
+        self.results = results
+        self.file_count = file_count
+
+    def as_dict (self):
+        return {label: value for (_, label, value) in self.results}
 
-    print ("All MIDI sound tracks have non-empty names: " + str (all_sound_tracks_have_names))
-    print ("No. of MIDI track names that don't match any PRGM effect names: " + str (unmatched_effect_name_count))
-    print ("Any MIDI track names match multiple PRGM effect names: " + str (any_ambiguous_effect_names))
+    def describe (self):
+        for (_, label, value) in self.results:
+            if type (value) == list:
+                print (label + ": " + str (len (value)))
+                for x in value:
+                    print ("  " + x)
+            else:
+                print (label + ": " + str (value))
+
+# Runs a set of checks (all registered ones by default) over every AMB in a single pass and returns a CorpusReport. amb_items is an iterable of
+# (path, Amb) pairs and defaults to the whole catalog.
+def run_corpus_checks (amb_items = None, check_classes = None):
+    if amb_items is None:
+        amb_items = ambs.items ()
+    if check_classes is None:
+        check_classes = corpus_checks
+    checks = [c () for c in check_classes]
+    file_count = 0
+    for (path, amb) in amb_items:
+        info = AmbCheckInfo (path, amb)
+        for check in checks:
+            check.visit (info)
+        file_count += 1
+    return make_corpus_report (checks, file_count)
+
+def make_corpus_report (checks, file_count):
+    results = []
+    for check in checks:
+        results += [(type (check).__name__, label, value) for (label, value) in check.report ()]
+    return CorpusReport (results, file_count)
+
+# Loads a batch of AMBs and runs instances of check_classes over them, returning (list of checks, number of files checked, list of AmbLoadFailures).
+# This is the unit of work handed to each process in check_amb_files, with check_classes bound by functools.partial so it's sent once per batch,
+# and only the checks and not the parsed Ambs are sent back from the workers.
+def check_amb_batch (check_classes, paths):
+    checks = [c () for c in check_classes]
+    file_count = 0
+    failures = []
+    for path in paths:
+        try:
+            amb = Amb (path)
+        except Exception as e:
+            failures.append (make_amb_load_failure (path, e))
+            continue
+        info = AmbCheckInfo (path, amb)
+        for check in checks:
+            check.visit (info)
+        file_count += 1
+    return (checks, file_count, failures)
+
+# Like run_corpus_checks but loads the AMBs in paths (the whole catalog by default) over "jobs" processes with map_in_batches instead of taking
+# them from the catalog. Each process runs the checks over its batches and the results are merged here. Returns the CorpusReport and the list of
+# AmbLoadFailures.
+def check_amb_files (paths = None, jobs = None, check_classes = None):
+    if paths is None:
+        paths = all_amb_paths
+    if check_classes is None:
+        check_classes = corpus_checks
+    checks = [c () for c in check_classes]
+    file_count = 0
+    failures = []
+    for (batch_checks, batch_file_count, batch_failures) in map_in_batches (functools.partial (check_amb_batch, check_classes), paths, jobs):
+        for (check, batch_check) in zip (checks, batch_checks):
+            check.merge (batch_check)
+        file_count += batch_file_count
+        failures += batch_failures
+    return (make_corpus_report (checks, file_count), failures)
+
+def investigate_format (catalog = None):
+    report = run_corpus_checks (catalog.items () if catalog is not None else None)
+    report.describe ()
+    return report
 
-    unreferenced_prgm_chunk_count = 0
-    multi_referenced_prgm_chunk_count = 0
-    for a in ambs.values ():
-        for prgm in a.chunks:
-            if type (prgm) == Prgm:
-                effect_name = prgm.str1
-                ref_count = len([x for x in a.midi.tracks[1:] if x.get_name ().casefold () == effect_name.casefold ()])
-                if ref_count == 0:
-                    unreferenced_prgm_chunk_count += 1
-                elif ref_count > 1:
-                    multi_referenced_prgm_chunk_count += 1
-
-    print ("No. of PRGM chunks with effect names not referenced by any track: " + str (unreferenced_prgm_chunk_count))
-    print ("No. of PRGM chunks with effect names referenced by two or more tracks: " + str(multi_referenced_prgm_chunk_count))
-
-    unreferenced_kmap_chunk_count = 0
-    multi_referenced_kmap_chunk_count = 0
-    for file_name, amb in ambs.items ():
-        for kmap in amb.chunks:
-            if type (kmap) == Kmap:
-                var_name = kmap.str1
-                ref_count = len([x for x in amb.chunks if type (x) == Prgm and x.str2 == var_name])
-                if ref_count == 0:
-                    unreferenced_kmap_chunk_count += 1
-                    # print (f"\t{var_name}\tin {file_name}")  # Print unmatched var names
-                elif ref_count > 1:
-                    multi_referenced_kmap_chunk_count += 1
-
-    print ("No. of KMAP chunks with var names not referenced by any PRGM: " + str (unreferenced_kmap_chunk_count))
-    print ("No. of KMAP chunks with var names referenced by two or more PRGMs: " + str(multi_referenced_kmap_chunk_count))
-
-    any_wave_files_contain_slashes = False
-    for kmap in list_all_chunks_of_type (Kmap):
-        for item in kmap.items:
-            if '/' in item.str1 or '\\' in item.str1:
-                any_wave_files_contain_slashes = True
-
-    print ("Any slashes appear in any wave file names: " + str (any_wave_files_contain_slashes))
-
-    most_prgms = 0
-    most_kmaps = 0
-    most_tracks = 0
-    for a in ambs.values ():
-        most_prgms  = max (most_prgms , len([x for x in a.chunks if type (x) == Prgm]))
-        most_kmaps  = max (most_kmaps , len([x for x in a.chunks if type (x) == Kmap]))
-        most_tracks = max (most_tracks, len(a.midi.tracks))
-    most_events = max([len(x.events) for x in list_all_midi_tracks ()])
+#
+# Serialization
+#
+# The describe methods print one line at a time, which is fine for looking at a single file but slow when dumping many and impossible to redirect.
+# Every chunk and event also has a describe_line method returning the line describe would print, and Amb, Midi, and MidiTrack have describe_lines
+# generators, so the same text can be written to any stream. For machine reading, get_amb_records generates the contents of an AMB as flat dicts
+# that dump_ambs writes out as NDJSON (one JSON object per line) or a JSON array with one object per file. Only one AMB's output is built at a time
+# so dumping the whole install takes the same memory as dumping one file.
+#
 
-    print ("Most PRGM chunks in any file: "  + str(most_prgms))
-    print ("Most KMAP chunks in any file: "  + str(most_kmaps))
-    print ("Most Midi tracks in any file: "  + str(most_tracks))
-    print ("Most events in any Midi track: " + str(most_events))
+# Returns the fields of a chunk, KMAP item, or MIDI event as a dict that can be converted to JSON. Bytes are written as hex strings and fields left
+# unset, like Aint1 & Aint2 in KmapItems, are skipped.
+def get_record_fields (obj):
+    tr = {}
+    for name in obj.__slots__:
+        if name == "__weakref__" or not hasattr (obj, name):
+            continue
+        value = getattr (obj, name)
+        if isinstance (value, bytes):
+            value = value.hex ()
+        elif isinstance (value, list):
+            value = [get_record_fields (v) if hasattr (v, "__slots__") else v for v in value]
+        tr[name] = value
+    return tr
 
-    all_times_zero_before_note_on = True
-    for a in ambs.values ():
-        for track in a.midi.tracks[1:]: # Skip info track
-            event_index = 0
-            while type (track.events[event_index]) != MidiNoteOn:
-                if track.events[event_index].delta_time != 0:
-                    all_times_zero_before_note_on = False
-                event_index += 1
-    print ("All event times zero before NoteOn: " + str(all_times_zero_before_note_on))
-
-    unexpected_prgm_size_count = 0
-    unexpected_size_kmaps = []
-    for prgm in list_all_chunks_of_type (Prgm):
-        if prgm.size != prgm.compute_size ():
-            unexpected_prgm_size_count += 1
-    for file_name, amb in ambs.items ():
-        for kmap in amb.chunks:
-            if type (kmap) == Kmap:
-                if kmap.size != kmap.compute_size ():
-                    unexpected_size_kmaps.append(f"{kmap.str1} in {file_name}")
-    print ("No. of PRGM chunks with unexpected sizes: " + str(unexpected_prgm_size_count))
-    print ("No. of KMAP chunks with unexpected sizes: " + str(len(unexpected_size_kmaps)))
-    for x in unexpected_size_kmaps:
-        print ("  " + x)
+# Generates one dict per chunk and one per MIDI event of amb. Chunk records have "type" set to the lowercase chunk tag and "index" set to the
+# position of the chunk in the file. Event records have "type" set to the event name as printed by describe (e.g. "NoteOn"), the index of their
+# track, and their absolute time in ticks and seconds.
+def get_amb_records (amb):
+    for (n, c) in enumerate (amb.chunks):
+        record = {"file": amb.file_path, "type": type (c).__name__.lower (), "index": n}
+        record.update (get_record_fields (c))
+        yield record
+    midi = amb.midi
+    seconds_per_tick = midi.seconds_per_quarter_note / midi.ticks_per_quarter_note
+    yield {"file": amb.file_path, "type": "midi", "ticks_per_quarter_note": midi.ticks_per_quarter_note,
+           "seconds_per_quarter_note": midi.seconds_per_quarter_note, "track_count": len (midi.tracks)}
+    for (track_index, track) in enumerate (midi.tracks):
+        tick = 0
+        seconds = 0
+        for e in track.iter_events ():
+            tick += e.delta_time
+            seconds += e.delta_time * seconds_per_tick
+            record = {"file": amb.file_path, "type": type (e).__name__[4:], "track": track_index, "tick": tick, "seconds": seconds}
+            record.update (get_record_fields (e))
+            yield record
+
+# Returns the contents of amb as a single nested dict: the file's chunk records under "chunks" and its Midi under "midi", with the event records of
+# each track in a list under "tracks". Used for the "json" format of dump_ambs.
+def get_amb_document (amb):
+    tr = {"file": amb.file_path, "chunks": [], "midi": None}
+    for record in get_amb_records (amb):
+        del record["file"]
+        if record["type"] == "midi":
+            tr["midi"] = record
+            record["tracks"] = [[] for t in range (record["track_count"])]
+        elif "track" in record:
+            tr["midi"]["tracks"][record.pop ("track")].append (record)
+        else:
+            tr["chunks"].append (record)
+    return tr
+
+dump_formats = ("text", "ndjson", "json")
+
+encode_json_record = json.JSONEncoder (ensure_ascii = False, separators = (",", ":")).encode
+
+# Returns the output of dump_ambs for a single AMB: its describe lines or NDJSON records, each followed by a newline, or for "json" its document
+# on one line with no separator
+def format_amb (amb, format):
+    if format == "text":
+        return "\n".join (amb.describe_lines ()) + "\n"
+    elif format == "ndjson":
+        return "\n".join ([encode_json_record (r) for r in get_amb_records (amb)]) + "\n"
+    else:
+        return encode_json_record (get_amb_document (amb))
+
+# Writes the output of format_amb for a number of AMBs to a text stream, adding the brackets and separators of a JSON array for "json". Returns the
+# number of AMBs written.
+def write_formatted_ambs (stream, formatted_ambs, format):
+    count = 0
+    if format == "json":
+        stream.write ("[")
+    for text in formatted_ambs:
+        if format == "json":
+            stream.write (("," if count > 0 else "") + "\n" + text)
+        else:
+            stream.write (text)
+        count += 1
+    if format == "json":
+        stream.write ("\n]\n")
+    return count
+
+# Writes AMBs to a text stream as describe-style text, NDJSON records, or a JSON array. amb_list can be any iterable of Ambs, e.g. a generator, and
+# defaults to every AMB in the catalog. Output for each file is joined and written in one call so for speed the stream should be buffered, as files
+# opened with open are. Returns the number of AMBs written. For example:
+#   >>> with open ("ambs.ndjson", "w", encoding = "utf-8") as f: dump_ambs (f, format = "ndjson")
+def dump_ambs (stream, amb_list = None, format = "text"):
+    if format not in dump_formats:
+        raise Exception ("Unknown dump format \"" + str (format) + "\", expected one of " + str (dump_formats))
+    if amb_list is None:
+        amb_list = ambs.values ()
+    return write_formatted_ambs (stream, (format_amb (amb, format) for amb in amb_list), format)
+
+#
+# Writing
+#
+# encode_amb turns an Amb back into the bytes of an AMB file. Chunk contents and track sizes are worked out first so the file is written into a
+# single preallocated bytearray. By default the size fields of PRGM, KMAP, and GLBL chunks are written as they were read, since some KMAPs in Civ 3
+# have size fields that don't match their contents (see ChunkSizeCheck) and we want unedited files to come out byte-identical. Pass recompute_sizes
+# after editing names so the size fields are taken from the encoded contents instead. MIDI tracks are written with or without running status
+# (leaving out the status byte of a channel event when it's the same as that of the previous event), see encode_amb.
+#
+
+prgm_fields_struct = struct.Struct ("<I5iI")
+kmap_fields_struct = struct.Struct ("<3I")
+
+# Table of the single byte encodings of MIDI variable length quantities, which are all the delta times in Civ 3 except a few
+midi_var_int_single_bytes = [bytes ([n]) for n in range (0x80)]
+
+def encode_midi_var_int (value):
+    if value < 0x80:
+        return midi_var_int_single_bytes[value]
+    tr = [value & 0x7F]
+    value >>= 7
+    while value > 0:
+        tr.append ((value & 0x7F) | 0x80)
+        value >>= 7
+    tr.reverse ()
+    return bytes (tr)
+
+# Returns the bytes of a MIDI event, including its delta time. status is the status byte of the previous event if running status may be used,
+# otherwise None. Events we couldn't parse can't be written back.
+def encode_midi_track_event (event, status):
+    kind = event.kind
+    delta_time = encode_midi_var_int (event.delta_time)
+    if kind == MidiNoteOn.kind or kind == MidiNoteOff.kind:
+        data = bytes ([event.key, event.velocity])
+    elif kind == MidiControlChange.kind:
+        data = bytes ([event.controller_number, event.value])
+    elif kind == MidiProgramChange.kind:
+        data = bytes ([event.program_number])
+    elif kind == MidiTrackName.kind:
+        name = event.name.encode ("utf-8")
+        return delta_time + b"\xFF\x03" + encode_midi_var_int (len (name)) + name
+    elif kind == MidiEndOfTrack.kind:
+        return delta_time + b"\xFF\x2F\x00"
+    elif kind == MidiSetTempo.kind:
+        return delta_time + b"\xFF\x51\x03" + event.microseconds_per_quarter_note.to_bytes (3, "big")
+    elif kind == MidiSMPTEOffset.kind:
+        return delta_time + bytes ([0xFF, 0x54, 0x05, event.hr, event.mn, event.se, event.fr, event.ff])
+    elif kind == MidiTimeSignature.kind:
+        return delta_time + bytes ([0xFF, 0x58, 0x04, event.nn, event.dd, event.cc, event.bb])
+    else:
+        raise Exception ("Can't write unknown MIDI event " + event.sig.hex (" "))
+    event_status = (kind << 4) | event.channel_number
+    if event_status == status:
+        return delta_time + data
+    return delta_time + bytes ([event_status]) + data
+
+# Returns the encoded events of a track as a list of bytes objects
+def encode_midi_track_events (track, running_status):
+    tr = []
+    status = None
+    for event in track.iter_events ():
+        tr.append (encode_midi_track_event (event, status))
+        if running_status and not is_midi_meta_event (event):
+            status = (event.kind << 4) | event.channel_number
+        else:
+            status = None
+    return tr
+
+# Returns whether a track, as it was read from its file, used running status. Civ 3 AMBs differ on this, so to write an unedited file back
+# identically we check which way of encoding the events matches the size the track was read with. Must be called before any events are edited.
+def get_midi_track_running_status (track):
+    return sum ([len (e) for e in encode_midi_track_events (track, False)]) != track.size
+
+amb_chunk_tags_by_class = {Prgm: b"prgm", Kmap: b"kmap", Glbl: b"glbl"}
+
+# Returns the bytes of a PRGM, KMAP, or GLBL chunk following its tag and size field. Strings are written as UTF-8, the same as read_string reads
+# them.
+def encode_amb_chunk_contents (c):
+    if type (c) == Prgm:
+        return prgm_fields_struct.pack (c.number, *c.dat, 0xFA) + c.str1.encode ("utf-8") + b"\0" + c.str2.encode ("utf-8") + b"\0"
+    elif type (c) == Kmap:
+        contents = [kmap_fields_struct.pack (c.int2, c.int3, c.int4), c.str1.encode ("utf-8"), b"\0", amb_uint_struct.pack (c.int5)]
+        if c.int6 is not None:
+            contents.append (amb_uint_struct.pack (c.int6))
+        for item in c.items:
+            if (c.int2 & 6) != 0:
+                contents.append (item.Bdat1)
+            else:
+                contents.append (struct.pack ("<2I", item.Aint1, item.Aint2))
+            contents += [item.str1.encode ("utf-8"), b"\0"]
+        contents.append (amb_uint_struct.pack (0xFA))
+        return b"".join (contents)
+    else:
+        return amb_uint_struct.pack (c.int2) + c.dat1 + c.dat2
+
+# Serializes amb to the bytes of an AMB file. running_status may be True or False to write all tracks with or without running status, a list with
+# one bool per track, or None to encode each track the way it was read (see get_midi_track_running_status).
+def encode_amb (amb, running_status = None, recompute_sizes = False):
+    midi = amb.midi
+    if running_status is None:
+        running_status = [get_midi_track_running_status (t) for t in midi.tracks]
+    elif type (running_status) == bool:
+        running_status = [running_status] * len (midi.tracks)
+    track_events = [encode_midi_track_events (t, rs) for (t, rs) in zip (midi.tracks, running_status)]
+    track_sizes = [sum ([len (e) for e in events]) for events in track_events]
+
+    chunk_contents = [encode_amb_chunk_contents (c) for c in amb.chunks]
+    total_size = sum ([8 + len (contents) for contents in chunk_contents]) + 14 + sum ([8 + size for size in track_sizes])
+    data = bytearray (total_size)
+    pos = 0
+
+    for (c, contents) in zip (amb.chunks, chunk_contents):
+        size_field = len (contents) if recompute_sizes else c.size
+        data[pos:pos + 8] = amb_chunk_tags_by_class[type (c)] + amb_uint_struct.pack (size_field)
+        data[pos + 8:pos + 8 + len (contents)] = contents
+        pos += 8 + len (contents)
+
+    data[pos:pos + 14] = b"MThd" + struct.pack (">IHHH", 6, 1, len (midi.tracks), midi.ticks_per_quarter_note)
+    pos += 14
+    for (events, size) in zip (track_events, track_sizes):
+        data[pos:pos + 8] = b"MTrk" + struct.pack (">I", size)
+        pos += 8
+        for e in events:
+            data[pos:pos + len (e)] = e
+            pos += len (e)
+
+    if pos != total_size:
+        raise Exception ("Encoded AMB is " + str (pos) + " bytes but " + str (total_size) + " were expected")
+    return bytes (data)
+
+def write_amb_file (amb, path, running_status = None, recompute_sizes = False):
+    data = encode_amb (amb, running_status, recompute_sizes)
+    temp_path = path + ".tmp"
+    with open (temp_path, "wb") as amb_file:
+        amb_file.write (data)
+    os.replace (temp_path, path)
+
+# Parses and re-encodes each file in a batch, returning (path, None) if the result is identical to the file or (path, message) otherwise
+def check_round_trip_batch (paths):
+    tr = []
+    for path in paths:
+        try:
+            with open (path, "rb") as amb_file:
+                data = amb_file.read ()
+            encoded = encode_amb (Amb (path, data))
+            if encoded == data:
+                tr.append ((path, None))
+                continue
+            offset = next ((n for (n, (a, b)) in enumerate (zip (data, encoded)) if a != b), min (len (data), len (encoded)))
+            tr.append ((path, "differs at offset {} (file is {} bytes, encoded is {})".format (offset, len (data), len (encoded))))
+        except Exception as e:
+            tr.append ((path, type (e).__name__ + ": " + str (e)))
+    return tr
+
+# Checks that every AMB in paths (the whole catalog by default) is written back byte-for-byte identical to the file it was read from. Prints any
+# mismatches and returns a list of (path, message) for them.
+def check_round_trip (paths = None, jobs = None):
+    if paths is None:
+        paths = all_amb_paths
+    mismatches = []
+    count = 0
+    for batch in map_in_batches (check_round_trip_batch, paths, jobs):
+        for (path, message) in batch:
+            count += 1
+            if message is not None:
+                print ("Round trip failed for \"" + path + "\": " + message)
+                mismatches.append ((path, message))
+    print ("{} of {} AMBs round-trip byte-identically".format (count - len (mismatches), count))
+    return mismatches
+
+# Edits for edit_amb_files. Each has an apply method that modifies an Amb in place. They're classes rather than functions so they can be sent to
+# other processes.
+
+# Multiplies the bounds of the randomized volume range of every PRGM (dat fields 3 & 4) by factor. Only affects sounds with random volume enabled.
+class ScalePrgmVolume:
+    def __init__ (self, factor):
+        self.factor = factor
+
+    def apply (self, amb):
+        for c in amb.chunks:
+            if type (c) == Prgm:
+                c.dat[3] = max (0, round (c.dat[3] * self.factor))
+                c.dat[4] = max (0, round (c.dat[4] * self.factor))
+
+# Stretches the timing of sound tracks by factor, e.g. 0.5 plays all sounds twice as close together. If track_names is given only tracks with
+# those names (case-insensitive) are changed. Event times are scaled from the start of the track and rounded so that rounding errors don't add up.
+class RetimeTracks:
+    def __init__ (self, factor, track_names = None):
+        self.factor = factor
+        self.track_names = None if track_names is None else set ([n.casefold () for n in track_names])
+
+    def apply (self, amb):
+        for track in amb.midi.tracks[1:]:
+            name = track.get_name ()
+            if self.track_names is not None and (name is None or name.casefold () not in self.track_names):
+                continue
+            tick = 0
+            scaled_tick = 0
+            for event in track.events:
+                tick += event.delta_time
+                new_scaled_tick = round (tick * self.factor)
+                event.delta_time = new_scaled_tick - scaled_tick
+                scaled_tick = new_scaled_tick
+        amb.midi.timeline = None
+
+# Applies edits to each (path, output path) in a batch, returning (path, output path or None, AmbLoadFailure or None)
+def edit_amb_batch (batch):
+    tr = []
+    for (path, output_path, edits) in batch:
+        try:
+            amb = Amb (path)
+            running_status = [get_midi_track_running_status (t) for t in amb.midi.tracks]
+            for edit in edits:
+                edit.apply (amb)
+            os.makedirs (os.path.dirname (output_path), exist_ok = True)
+            write_amb_file (amb, output_path, running_status, recompute_sizes = True)
+            tr.append ((path, output_path, None))
+        except Exception as e:
+            tr.append ((path, None, make_amb_load_failure (path, e)))
+    return tr
+
+# Applies a list of edits to many AMBs (the whole catalog by default), spreading the work over "jobs" processes. Edited files are written under
+# output_dir at the same path relative to root_dir that the original has, e.g. to build a mod's Art/Units folder. Passing the original directory
+# as output_dir overwrites the files. Returns a dict mapping AMB paths to output file paths and a list of AmbLoadFailures. For example:
+#   >>> edit_amb_files ([ScalePrgmVolume (0.5), RetimeTracks (1.2)], "MyMod", list_unit_amb_paths ("Catapult"))
+def edit_amb_files (edits, output_dir, paths = None, root_dir = civ3_root_dir, jobs = None):
+    if paths is None:
+        paths = all_amb_paths
+    work = [(path, os.path.join (output_dir, os.path.relpath (path, root_dir)), edits) for path in paths]
+    edited = {}
+    failures = []
+    for batch in map_in_batches (edit_amb_batch, work, jobs):
+        for (path, output_path, failure) in batch:
+            if output_path is not None:
+                edited[path] = output_path
+            else:
+                failures.append (failure)
+    return (edited, failures)
+
+#
+# SQLite export
+#
+# export_to_sqlite writes the parsed contents of many AMBs into a SQLite database so that questions about the whole corpus can be answered with SQL
+# instead of by reparsing every file. Each table has a file_id column referring to the files table. Chunks are numbered by their position in the
+# file (chunk_index) and MIDI tracks and events by their position in the Midi and track. Every table is indexed on file_id so that joins back to
+# files and the deletes done by incremental exports don't scan whole tables.
+#
+
+sqlite_schema = """
+CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, unit TEXT, size INTEGER, mtime_ns INTEGER,
+                                  ticks_per_quarter_note INTEGER, seconds_per_quarter_note REAL);
+CREATE TABLE IF NOT EXISTS prgms (file_id INTEGER, chunk_index INTEGER, number INTEGER, size INTEGER, computed_size INTEGER,
+                                  dat0 INTEGER, dat1 INTEGER, dat2 INTEGER, dat3 INTEGER, dat4 INTEGER, effect_name TEXT, var_name TEXT);
+CREATE TABLE IF NOT EXISTS kmaps (file_id INTEGER, chunk_index INTEGER, size INTEGER, computed_size INTEGER, int2 INTEGER, int3 INTEGER,
+                                  int4 INTEGER, var_name TEXT, item_count INTEGER, int6 INTEGER);
+CREATE TABLE IF NOT EXISTS kmap_items (file_id INTEGER, chunk_index INTEGER, item_index INTEGER, data BLOB, wave_name TEXT);
+CREATE TABLE IF NOT EXISTS glbls (file_id INTEGER, chunk_index INTEGER, size INTEGER, int2 INTEGER, dat1 BLOB, dat2 BLOB);
+CREATE TABLE IF NOT EXISTS tracks (file_id INTEGER, track_index INTEGER, name TEXT, size INTEGER, event_count INTEGER, length_ticks INTEGER);
+CREATE TABLE IF NOT EXISTS events (file_id INTEGER, track_index INTEGER, event_index INTEGER, kind INTEGER, delta_time INTEGER, tick INTEGER,
+                                   seconds REAL, channel INTEGER, data1 INTEGER, data2 INTEGER, value INTEGER, text TEXT);
+CREATE TABLE IF NOT EXISTS event_kinds (kind INTEGER PRIMARY KEY, name TEXT);
+CREATE INDEX IF NOT EXISTS prgms_effect_name ON prgms (effect_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS prgms_var_name ON prgms (var_name);
+CREATE INDEX IF NOT EXISTS kmaps_var_name ON kmaps (var_name);
+CREATE INDEX IF NOT EXISTS kmap_items_wave_name ON kmap_items (wave_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS tracks_name ON tracks (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS events_kind ON events (kind);
+CREATE INDEX IF NOT EXISTS prgms_file_id ON prgms (file_id, chunk_index);
+CREATE INDEX IF NOT EXISTS kmaps_file_id ON kmaps (file_id, chunk_index);
+CREATE INDEX IF NOT EXISTS kmap_items_file_id ON kmap_items (file_id, chunk_index, item_index);
+CREATE INDEX IF NOT EXISTS glbls_file_id ON glbls (file_id, chunk_index);
+CREATE INDEX IF NOT EXISTS tracks_file_id ON tracks (file_id, track_index);
+CREATE INDEX IF NOT EXISTS events_file_id ON events (file_id, track_index, event_index);
+"""
+
+sqlite_file_tables = ["prgms", "kmaps", "kmap_items", "glbls", "tracks", "events", "files"]
+
+# Appends the rows describing one AMB to the lists in "rows", which maps table names to lists of row tuples
+def add_amb_sqlite_rows (rows, file_id, path, stat, amb):
+    midi = amb.midi
+    rows["files"].append ((file_id, path, os.path.basename (os.path.dirname (path)), stat.st_size, stat.st_mtime_ns, midi.ticks_per_quarter_note,
+                           midi.seconds_per_quarter_note))
+    for (chunk_index, chunk) in enumerate (amb.chunks):
+        if chunk.__class__ is Prgm:
+            rows["prgms"].append ((file_id, chunk_index, chunk.number, chunk.size, chunk.compute_size ()) + tuple (chunk.dat) + (chunk.str1, chunk.str2))
+        elif chunk.__class__ is Kmap:
+            rows["kmaps"].append ((file_id, chunk_index, chunk.size, chunk.compute_size (), chunk.int2, chunk.int3, chunk.int4, chunk.str1, chunk.int5,
+                                   chunk.int6))
+            for (item_index, item) in enumerate (chunk.items):
+                data = getattr (item, "Bdat1", None)
+                rows["kmap_items"].append ((file_id, chunk_index, item_index, data, item.str1))
+        elif chunk.__class__ is Glbl:
+            rows["glbls"].append ((file_id, chunk_index, chunk.size, chunk.int2, chunk.dat1, chunk.dat2))
+
+    seconds_per_tick = midi.seconds_per_quarter_note / midi.ticks_per_quarter_note
+    for (track_index, track) in enumerate (midi.tracks):
+        tick = 0
+        events = track.events
+        for (event_index, event) in enumerate (events):
+            tick += event.delta_time
+            kind = event.kind
+            value = None
+            text = None
+            if kind == MidiTrackName.kind:
+                text = event.name
+            elif kind == MidiSetTempo.kind:
+                value = event.microseconds_per_quarter_note
+            (channel, data1, data2) = get_midi_event_data (event)
+            rows["events"].append ((file_id, track_index, event_index, kind, event.delta_time, tick, tick * seconds_per_tick, channel, data1, data2,
+                                    value, text))
+        rows["tracks"].append ((file_id, track_index, track.get_name (), track.size, len (events), tick))
+
+# Parses the AMBs in a batch of (file_id, path, stat) and returns their rows, in the same form as add_amb_sqlite_rows, plus a list of
+# AmbLoadFailures. Used by export_to_sqlite with map_in_batches so that only the rows, not the parsed Ambs, are sent back from the worker processes.
+def make_sqlite_rows_batch (work):
+    rows = {table: [] for table in sqlite_file_tables}
+    failures = []
+    for (file_id, path, stat) in work:
+        try:
+            amb = Amb (path)
+        except Exception as e:
+            failures.append (make_amb_load_failure (path, e))
+            continue
+        add_amb_sqlite_rows (rows, file_id, path, stat, amb)
+    return (rows, failures)
+
+# Writes the AMBs in paths (the whole catalog by default) into the SQLite database at db_path, parsing them and building their rows over "jobs"
+# processes with map_in_batches. Rows are written with executemany inside a single transaction. With incremental, files whose size and modification
+# time match what's already in the database are skipped and rows are only rewritten for new or changed files, rows for files no longer in paths are
+# removed. Otherwise the database is cleared first. Returns a dict with the numbers of files written, unchanged, and removed, and the list of
+# AmbLoadFailures.
+def export_to_sqlite (db_path, paths = None, incremental = False, jobs = None):
+    if paths is None:
+        paths = all_amb_paths
+    connection = sqlite3.connect (db_path)
+    try:
+        connection.executescript (sqlite_schema)
+        with connection:
+            known_files = {}
+            if incremental:
+                for (file_id, path, size, mtime_ns) in connection.execute ("SELECT file_id, path, size, mtime_ns FROM files"):
+                    known_files[path] = (file_id, size, mtime_ns)
+            else:
+                for table in sqlite_file_tables:
+                    connection.execute ("DELETE FROM " + table)
+
+            stats = {}
+            changed_paths = []
+            stale_file_ids = []
+            failures = []
+            unchanged_count = 0
+            for path in paths:
+                # A file that can't be read any more, e.g. because it was deleted since the scan, is reported like one that fails to parse. Its
+                # rows from an earlier export are removed along with those of files no longer in paths.
+                try:
+                    stat = os.stat (path)
+                except OSError as e:
+                    failures.append (make_amb_load_failure (path, e))
+                    continue
+                known = known_files.pop (path, None)
+                if known is not None and known[1] == stat.st_size and known[2] == stat.st_mtime_ns:
+                    unchanged_count += 1
+                    continue
+                if known is not None:
+                    stale_file_ids.append ((known[0],))
+                changed_paths.append (path)
+                stats[path] = stat
+            removed_file_ids = [(file_id,) for (file_id, _, _) in known_files.values ()]
+            for table in sqlite_file_tables:
+                connection.executemany ("DELETE FROM " + table + " WHERE file_id = ?", stale_file_ids + removed_file_ids)
+
+            (next_file_id,) = connection.execute ("SELECT COALESCE (MAX (file_id), 0) + 1 FROM files").fetchone ()
+            work = [(next_file_id + n, path, stats[path]) for (n, path) in enumerate (changed_paths)]
+            written_count = len (work)
+            for (rows, batch_failures) in map_in_batches (make_sqlite_rows_batch, work, jobs):
+                failures += batch_failures
+                written_count -= len (batch_failures)
+                for (table, table_rows) in rows.items ():
+                    if len (table_rows) > 0:
+                        placeholders = ", ".join (["?"] * len (table_rows[0]))
+                        connection.executemany ("INSERT INTO " + table + " VALUES (" + placeholders + ")", table_rows)
+
+            event_classes = [MidiTrackUnknownEvent, MidiTrackName, MidiSMPTEOffset, MidiTimeSignature, MidiSetTempo, MidiEndOfTrack, MidiNoteOff,
+                             MidiNoteOn, MidiControlChange, MidiProgramChange]
+            connection.executemany ("INSERT OR REPLACE INTO event_kinds VALUES (?, ?)", [(c.kind, c.__name__) for c in event_classes])
+        connection.execute ("ANALYZE")
+    finally:
+        connection.close ()
+    return {"written": written_count, "unchanged": unchanged_count, "removed": len (removed_file_ids), "failures": failures}
+
+#
+# Audio rendering
+#
+# The sound an AMB describes can be worked out from its contents: each MIDI sound track is named after the effect name of a PRGM chunk (str1), the
+# PRGM's var name (str2) matches the var name of a KMAP chunk (str1), and that KMAP's item names the wave file to play. The NoteOn events in the
+# track give the times at which to play it and the PRGM's dat fields give the bounds for randomizing its playback speed and volume. The functions
+# below mix all of that into a PCM buffer. This requires NumPy.
+#
+
+# One playback of a wave file by an AMB. start_time and end_time are in seconds and come from the NoteOn and matching NoteOff (end_time is None if
+# there isn't one). speed is a playback rate multiplier and volume is a gain between 0 and 1.
+class AmbVoice:
+    __slots__ = ("effect_name", "wave_name", "start_time", "end_time", "speed", "volume")
+
+    def __init__ (self, effect_name, wave_name, start_time, end_time, speed, volume):
+        self.effect_name = effect_name
+        self.wave_name = wave_name
+        self.start_time = start_time
+        self.end_time = end_time
+        self.speed = speed
+        self.volume = volume
+
+# Picks the randomized playback speed multiplier and volume for one playback of prgm. Bit 0 of dat[0] enables random speed between dat[2] and
+# dat[1], which are in units where 100 points is roughly a semitone (about 6%). Bit 1 enables random volume between dat[4] and dat[3], which are
+# treated as MIDI-style levels out of 127.
+def roll_prgm_speed_and_volume (prgm, rng):
+    speed = 1.0
+    volume = 1.0
+    if prgm.dat[0] & 1:
+        speed = 2 ** (rng.uniform (min (prgm.dat[2], prgm.dat[1]), max (prgm.dat[2], prgm.dat[1])) / 1200)
+    if prgm.dat[0] & 2:
+        volume = min (rng.uniform (min (prgm.dat[4], prgm.dat[3]), max (prgm.dat[4], prgm.dat[3])), 127) / 127
+    return (speed, volume)
+
+# Works out every wave file playback the AMB calls for, as a list of AmbVoices sorted by start time. rng is a random.Random used to pick the speed and
+# volume of each playback, so passing in a generator with a fixed seed gives repeatable results. Tracks whose name doesn't lead to a wave file are
+# skipped.
+def compile_amb_voices (amb, rng):
+    prgms_by_effect = {}
+    kmaps_by_var = {}
+    for chunk in amb.chunks:
+        if chunk.__class__ is Prgm:
+            prgms_by_effect.setdefault (chunk.str1.casefold (), chunk)
+        elif chunk.__class__ is Kmap:
+            kmaps_by_var.setdefault (chunk.str1, chunk)
+
+    seconds_per_tick = amb.midi.seconds_per_quarter_note / amb.midi.ticks_per_quarter_note
+    tr = []
+    for track in amb.midi.tracks[1:]: # Skip first track which has metadata
+        name = track.get_name ()
+        prgm = prgms_by_effect.get (name.casefold ()) if name is not None else None
+        kmap = kmaps_by_var.get (prgm.str2) if prgm is not None else None
+        if kmap is None or len (kmap.items) == 0:
+            continue
+        tick = 0
+        track_voices = []
+        for event in track.iter_events ():
+            tick += event.delta_time
+            if event.kind == MidiNoteOn.kind and event.velocity > 0:
+                (speed, volume) = roll_prgm_speed_and_volume (prgm, rng)
+                track_voices.append (AmbVoice (prgm.str1, kmap.items[0].str1, tick * seconds_per_tick, None, speed, volume * event.velocity / 127))
+            elif event.kind == MidiNoteOff.kind or (event.kind == MidiNoteOn.kind and event.velocity == 0):
+                for voice in track_voices:
+                    if voice.end_time is None:
+                        voice.end_time = tick * seconds_per_tick
+                        break
+        tr += track_voices
+    tr.sort (key = lambda v: v.start_time)
+    return tr
+
+# Finds the wave files named by AMBs. A wave is looked for first in the AMB's own folder, then in the unit folder of the same name in each of the art
+# directories, starting from the last one (Conquests, then PTW, then vanilla) since that's the order in which the game lets expansions override
+# files. Names are compared ignoring case since the names in KMAP chunks don't always match the case of the actual files. Folder listings and
+# resolved paths are memoized, call clear if files are added or removed.
+class WavePathResolver:
+    def __init__ (self, art_paths):
+        self.art_paths = art_paths
+        self.folder_listings = {} # Maps folder path to dict mapping case-folded file names to actual names
+        self.resolved_paths = {}  # Maps (AMB folder, case-folded wave name) to the resolved path
+
+    def clear (self):
+        self.folder_listings = {}
+        self.resolved_paths = {}
+
+    def find_in_folder (self, folder, folded_wave_name):
+        listing = self.folder_listings.get (folder)
+        if listing is None:
+            listing = {}
+            if os.path.isdir (folder):
+                for file_name in os.listdir (folder):
+                    listing[file_name.casefold ()] = file_name
+            self.folder_listings[folder] = listing
+        file_name = listing.get (folded_wave_name)
+        return os.path.join (folder, file_name) if file_name is not None else None
+
+    def resolve (self, amb_path, wave_name):
+        amb_folder = os.path.dirname (amb_path)
+        key = (amb_folder, wave_name.casefold ())
+        tr = self.resolved_paths.get (key)
+        if tr is not None:
+            return tr
+        unit_name = os.path.basename (amb_folder)
+        for folder in [amb_folder] + [os.path.join (art_path, unit_name) for art_path in reversed (self.art_paths)]:
+            tr = self.find_in_folder (folder, key[1])
+            if tr is not None:
+                self.resolved_paths[key] = tr
+                return tr
+        raise Exception ("Wave file \"" + wave_name + "\" not found for \"" + amb_path + "\"")
+
+wave_path_resolver = WavePathResolver (civ3_unit_art_paths)
+
+def find_amb_wave_path (amb_path, wave_name):
+    return wave_path_resolver.resolve (amb_path, wave_name)
+
+# Keeps decoded wave files in memory so that sounds shared by many AMBs are only read and decoded once. Entries are keyed by path and checked against
+# the file's modification time, the samples are stored as read-only arrays so they can be shared safely. When the total size of the stored samples
+# exceeds max_bytes, the least recently used waves are evicted.
+class SampleCache:
+    def __init__ (self, max_bytes = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict () # Maps path to (mtime_ns, samples, sample_rate)
+        self.total_bytes = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+
+    # Returns (samples, sample_rate) like read_wave_file
+    def load (self, path):
+        mtime_ns = os.stat (path).st_mtime_ns
+        entry = self.entries.get (path)
+        if entry is not None:
+            if entry[0] == mtime_ns:
+                self.entries.move_to_end (path)
+                self.hit_count += 1
+                return (entry[1], entry[2])
+            self.remove (path)
+        self.miss_count += 1
+        (samples, sample_rate) = read_wave_file (path)
+        samples.flags.writeable = False
+        self.entries[path] = (mtime_ns, samples, sample_rate)
+        self.total_bytes += samples.nbytes
+        while self.total_bytes > self.max_bytes and len (self.entries) > 1:
+            self.remove (next (iter (self.entries)))
+            self.eviction_count += 1
+        return (samples, sample_rate)
+
+    def remove (self, path):
+        (_, samples, _) = self.entries.pop (path)
+        self.total_bytes -= samples.nbytes
+
+    def hit_rate (self):
+        lookup_count = self.hit_count + self.miss_count
+        return self.hit_count / lookup_count if lookup_count > 0 else 0
+
+    def stats (self):
+        return {"entries": len (self.entries), "bytes": self.total_bytes, "hits": self.hit_count, "misses": self.miss_count,
+                "evictions": self.eviction_count, "hit_rate": self.hit_rate ()}
+
+sample_cache = SampleCache ()
+
+# Reads a PCM wave file, returning its samples as a mono float32 NumPy array with values between -1 and 1, plus its sample rate. Stereo files are
+# mixed down to mono.
+def read_wave_file (path):
+    with wave.open (path, "rb") as wave_file:
+        channel_count = wave_file.getnchannels ()
+        sample_width = wave_file.getsampwidth ()
+        sample_rate = wave_file.getframerate ()
+        frames = wave_file.readframes (wave_file.getnframes ())
+    if sample_width == 1:
+        samples = (numpy.frombuffer (frames, dtype = "u1").astype ("f4") - 128) / 128
+    elif sample_width == 2:
+        samples = numpy.frombuffer (frames, dtype = "<i2").astype ("f4") / 32768
+    else:
+        raise Exception ("Unsupported sample width " + str (sample_width) + " in wave file \"" + path + "\"")
+    if channel_count > 1:
+        samples = samples.reshape (-1, channel_count).mean (axis = 1, dtype = "f4")
+    return (samples, sample_rate)
+
+def write_wave_file (path, samples, sample_rate):
+    pcm = (numpy.clip (samples, -1, 1) * 32767).astype ("<i2")
+    with wave.open (path, "wb") as wave_file:
+        wave_file.setnchannels (1)
+        wave_file.setsampwidth (2)
+        wave_file.setframerate (sample_rate)
+        wave_file.writeframes (pcm.tobytes ())
+
+# Resamples a wave for playback at speed times its normal rate, converting from source_rate to target_rate at the same time, by linear
+# interpolation
+def resample_wave (samples, source_rate, target_rate, speed):
+    step = source_rate * speed / target_rate # Source samples per output sample
+    output_length = int (len (samples) / step)
+    if step == 1:
+        return samples[:output_length]
+    positions = numpy.arange (output_length, dtype = "f8") * step
+    return numpy.interp (positions, numpy.arange (len (samples)), samples).astype ("f4")
+
+# Mixes all the sounds of an AMB into a single mono float32 NumPy array at sample_rate. seed makes the random speed and volume of each sound
+# repeatable. Every sound plays to the end of its wave file, the NoteOff events seem to matter only to MIDI and are ignored. Waves are loaded
+# through "samples", which defaults to the shared sample_cache.
+def render_amb (amb, sample_rate = 22050, seed = None, samples = None):
+    if numpy is None:
+        raise Exception ("Rendering AMBs requires NumPy")
+    if samples is None:
+        samples = sample_cache
+    voices = compile_amb_voices (amb, random.Random (seed))
+    placed = []
+    for voice in voices:
+        (wave_samples, wave_rate) = samples.load (find_amb_wave_path (amb.file_path, voice.wave_name))
+        start = int (round (voice.start_time * sample_rate))
+        placed.append ((start, resample_wave (wave_samples, wave_rate, sample_rate, voice.speed), voice.volume))
+    tr = numpy.zeros (max ([start + len (s) for (start, s, _) in placed], default = 0), dtype = "f4")
+    for (start, voice_samples, volume) in placed:
+        tr[start:start + len (voice_samples)] += voice_samples * volume
+    return tr
+
+# Renders each AMB in a batch to a wave file, for use with map_in_batches. The seed for each file is derived from its path so results don't depend
+# on how the files were split into batches.
+def render_amb_batch (batch):
+    tr = []
+    for (path, output_path, sample_rate, seed) in batch:
+        try:
+            amb = Amb (path)
+            samples = render_amb (amb, sample_rate, None if seed is None else seed ^ zlib.crc32 (path.encode ("utf-8")))
+            write_wave_file (output_path, samples, sample_rate)
+            tr.append ((path, output_path, None))
+        except Exception as e:
+            tr.append ((path, None, make_amb_load_failure (path, e)))
+    return tr
+
+# Renders many AMBs (the whole catalog by default) to wave files in output_dir, spreading the work over "jobs" processes. Returns a dict mapping AMB
+# paths to output file paths and a list of AmbLoadFailures for the files that couldn't be rendered.
+def render_amb_files (output_dir, paths = None, jobs = None, sample_rate = 22050, seed = 0):
+    if paths is None:
+        paths = all_amb_paths
+    os.makedirs (output_dir, exist_ok = True)
+
+    # Name each output file after the AMB and its unit folder. The same unit folder can appear in the vanilla, PTW, and Conquests art directories so
+    # number any repeated names.
+    work = []
+    used_names = set ()
+    for path in paths:
+        (folder, file_name) = os.path.split (path)
+        base_name = os.path.basename (folder) + "_" + os.path.splitext (file_name)[0]
+        output_name = base_name
+        n = 1
+        while output_name.casefold () in used_names:
+            n += 1
+            output_name = base_name + "_" + str (n)
+        used_names.add (output_name.casefold ())
+        work.append ((path, os.path.join (output_dir, output_name + ".wav"), sample_rate, seed))
+
+    rendered = {}
+    failures = []
+    for batch in map_in_batches (render_amb_batch, work, jobs):
+        for (path, output_path, failure) in batch:
+            if output_path is not None:
+                rendered[path] = output_path
+            else:
+                failures.append (failure)
+    return (rendered, failures)
+
+# Lists the AMBs in the catalog from the unit folder with the given name, e.g. to pass to render_amb_files
+def list_unit_amb_paths (unit_name):
+    unit_name = unit_name.casefold ()
+    return [p for p in all_amb_paths if os.path.basename (os.path.dirname (p)).casefold () == unit_name]
+
+# One sound being played by a BlockMixer. start is the output sample at which the sound begins, step is the number of wave samples to advance per
+# output sample (which accounts for both the playback speed and any difference in sample rates), and position is the current position in the wave.
+class MixerVoice:
+    __slots__ = ("start", "samples", "step", "volume", "position")
+
+    def __init__ (self, start, samples, step, volume):
+        self.start = start
+        self.samples = samples
+        self.step = step
+        self.volume = volume
+        self.position = 0.0
+
+    # Adds this voice's contribution to a block of output starting at output sample block_start. Returns False once the voice has finished.
+    def mix_into (self, block, block_start):
+        offset = max (0, self.start - block_start)
+        last_index = len (self.samples) - 1
+        count = min (len (block) - offset, math.ceil ((last_index - self.position) / self.step))
+        if count > 0:
+            positions = self.position + numpy.arange (count) * self.step
+            indices = positions.astype ("i8")
+            fractions = (positions - indices).astype ("f4")
+            block[offset:offset + count] += (self.samples[indices] * (1 - fractions) + self.samples[indices + 1] * fractions) * self.volume
+        self.position += (len (block) - offset) * self.step
+        return self.position < last_index
+
+# Streaming mixer for many AMBs playing at once, for example every unit in a battle. Each call to play compiles an AMB into voices scheduled at
+# absolute output sample positions, then render_block produces the output one fixed-size block at a time. Voices wait in a heap until their start
+# time comes around, so the work done per block depends only on the number of voices actually sounding during it. Waves are resampled block by
+# block as they're played. The mixer keeps the render time and active voice count of recent blocks for monitoring.
+class BlockMixer:
+    def __init__ (self, sample_rate = 22050, block_size = 512, samples = None, history_size = 1000):
+        if numpy is None:
+            raise Exception ("BlockMixer requires NumPy")
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.samples = samples if samples is not None else sample_cache
+        self.pending = [] # Heap of (start, sequence number, MixerVoice)
+        self.active = []
+        self.position = 0 # Output sample at which the next block begins
+        self.voice_count = 0 # Total number of voices ever scheduled, used to break ties in the heap
+        self.block_latencies = collections.deque (maxlen = history_size)
+        self.block_voice_counts = collections.deque (maxlen = history_size)
+
+    # Schedules all the sounds of an AMB to start playing start_offset seconds after the beginning of the next block
+    def play (self, amb, start_offset = 0.0, seed = None):
+        rng = random.Random (seed)
+        for voice in compile_amb_voices (amb, rng):
+            (wave_samples, wave_rate) = self.samples.load (find_amb_wave_path (amb.file_path, voice.wave_name))
+            if len (wave_samples) < 2:
+                continue
+            start = self.position + int (round ((start_offset + voice.start_time) * self.sample_rate))
+            mixer_voice = MixerVoice (start, wave_samples, wave_rate * voice.speed / self.sample_rate, voice.volume)
+            heapq.heappush (self.pending, (start, self.voice_count, mixer_voice))
+            self.voice_count += 1
+
+    def is_idle (self):
+        return len (self.pending) == 0 and len (self.active) == 0
+
+    def render_block (self):
+        start_time = time.perf_counter ()
+        block_end = self.position + self.block_size
+        while len (self.pending) > 0 and self.pending[0][0] < block_end:
+            self.active.append (heapq.heappop (self.pending)[2])
+        block = numpy.zeros (self.block_size, dtype = "f4")
+        self.active = [v for v in self.active if v.mix_into (block, self.position)]
+        self.block_voice_counts.append (len (self.active))
+        self.position = block_end
+        self.block_latencies.append (time.perf_counter () - start_time)
+        return block
+
+    def stats (self):
+        latencies = sorted (self.block_latencies)
+        return {"active_voices": len (self.active),
+                "pending_voices": len (self.pending),
+                "peak_voices": max (self.block_voice_counts, default = 0),
+                "block_deadline": self.block_size / self.sample_rate,
+                "mean_latency": sum (latencies) / len (latencies) if len (latencies) > 0 else 0,
+                "p99_latency": latencies[int (0.99 * (len (latencies) - 1))] if len (latencies) > 0 else 0,
+                "max_latency": latencies[-1] if len (latencies) > 0 else 0}
+
+# Measures how many copies of an AMB a BlockMixer can play simultaneously while rendering each block in less time than the block lasts. Instance
+# counts are doubled until the 99th percentile block render time misses the deadline. Returns a list of (instance count, stats) pairs.
+def benchmark_block_mixer (amb, sample_rate = 22050, block_size = 512, max_instances = 4096):
+    tr = []
+    instance_count = 1
+    while instance_count <= max_instances:
+        mixer = BlockMixer (sample_rate, block_size)
+        for n in range (instance_count):
+            mixer.play (amb, seed = n)
+        while not mixer.is_idle ():
+            mixer.render_block ()
+        stats = mixer.stats ()
+        tr.append ((instance_count, stats))
+        print ("{} instances: peak {} voices, p99 block time {:.2f} ms (deadline {:.2f} ms)".format (instance_count, stats["peak_voices"],
+                                                                                                   stats["p99_latency"] * 1000,
+                                                                                                   stats["block_deadline"] * 1000))
+        if stats["p99_latency"] > stats["block_deadline"]:
+            break
+        instance_count *= 2
+    return tr
+
+#
+# Command line interface
+#
+# Running the script with arguments performs one task and exits instead of starting an interactive session, e.g.:
+#   py AMBReader.py --root "C:\GOG Games\Civilization III Complete" describe TrebuchetRun
+#   py AMBReader.py --art-dir MyMod\Art\Units --jobs 8 validate
+# Install roots are taken from --root and --art-dir, or if neither is given, from the CIV3_ROOT and CIV3_ART_DIRS environment variables (lists of
+# directories separated by os.pathsep), or failing that, civ3_root_dir. Only the files a command needs are loaded. The exit code is 0 on success,
+# 1 if files couldn't be loaded, failed validation, or nothing matched, and 2 if the arguments were invalid.
+#
+
+def get_civ3_unit_art_paths (root_dir):
+    return [os.path.join (root_dir, "Art", "Units"), os.path.join (root_dir, "civ3PTW", "Art", "Units"), os.path.join (root_dir, "Conquests", "Art", "Units")]
+
+def get_command_art_paths (args):
+    roots = args.root or []
+    art_dirs = args.art_dir or []
+    if len (roots) == 0 and len (art_dirs) == 0:
+        roots = [r for r in os.environ.get ("CIV3_ROOT", "").split (os.pathsep) if r != ""]
+        art_dirs = [d for d in os.environ.get ("CIV3_ART_DIRS", "").split (os.pathsep) if d != ""]
+    if len (roots) == 0 and len (art_dirs) == 0:
+        roots = [civ3_root_dir]
+    tr = []
+    for root in roots:
+        tr += get_civ3_unit_art_paths (root)
+    return tr + art_dirs
+
+# Returns, for each (path, format) in a batch, (path, output of format_amb or None, AmbLoadFailure or None)
+def format_amb_batch (batch):
+    tr = []
+    for (path, format) in batch:
+        try:
+            tr.append ((path, format_amb (Amb (path), format), None))
+        except Exception as e:
+            tr.append ((path, None, make_amb_load_failure (path, e)))
+    return tr
+
+# Generates the output of format_amb for each of paths, loading and formatting them over "jobs" processes, and appends an AmbLoadFailure to failures
+# for each that can't be loaded. Batches are worked on ahead of time by the pool but consumed in order, so only a few are in memory at once.
+def iter_formatted_ambs (paths, format, jobs, failures):
+    for batch in map_in_batches (format_amb_batch, [(p, format) for p in paths], jobs):
+        for (path, text, failure) in batch:
+            if text is not None:
+                yield text
+            else:
+                failures.append (failure)
+
+# Prints load failures to stderr and returns how many there were
+def report_load_failures (failures):
+    for failure in failures:
+        failure.describe (sys.stderr)
+    return len (failures)
+
+def scan_toc_batch (batch):
+    tr = []
+    for (path, read_names) in batch:
+        try:
+            tr.append ((path, scan_toc (path, read_names), None))
+        except Exception as e:
+            tr.append ((path, None, make_amb_load_failure (path, e)))
+    return tr
+
+# Returns, for each file in a batch, (path, list of problems, AmbLoadFailure or None). The problems are chunks with size fields that don't match the
+# size computed from their contents.
+def validate_amb_batch (paths):
+    tr = []
+    for path in paths:
+        try:
+            amb = Amb (path)
+        except Exception as e:
+            tr.append ((path, [], make_amb_load_failure (path, e)))
+            continue
+        problems = []
+        for (n, c) in enumerate (amb.chunks):
+            if type (c) in (Prgm, Kmap) and c.size != c.compute_size ():
+                problems.append ("{} chunk {} '{}' has size {} but its contents are {} bytes".format (type (c).__name__.lower (), n, c.str1, c.size,
+                                                                                                     c.compute_size ()))
+        tr.append ((path, problems, None))
+    return tr
+
+def run_describe_command (args, paths):
+    failures = []
+    write_formatted_ambs (sys.stdout, iter_formatted_ambs (paths, args.format, args.jobs, failures), args.format)
+    return report_load_failures (failures)
+
+def run_stats_command (args, paths):
+    (report, failures) = check_amb_files (paths, args.jobs)
+    if args.json:
+        json.dump ({"file_count": report.file_count, "results": report.as_dict ()}, sys.stdout, indent = 2)
+        print ()
+    else:
+        report.describe ()
+    return report_load_failures (failures)
+
+def run_toc_command (args, paths):
+    failures = []
+    for batch in map_in_batches (scan_toc_batch, [(p, args.names) for p in paths], args.jobs):
+        for (path, toc, failure) in batch:
+            if toc is None:
+                failures.append (failure)
+                continue
+            print (path + ":")
+            for entry in toc:
+                entry.describe ()
+    return report_load_failures (failures)
+
+def run_export_command (args, paths):
+    failures = []
+    if args.format == "sqlite":
+        if args.output == "-":
+            raise Exception ("Can't export a SQLite database to stdout")
+        with contextlib.redirect_stdout (sys.stderr):
+            result = export_to_sqlite (args.output, paths, args.incremental, args.jobs)
+        return report_load_failures (result["failures"])
+    formatted = iter_formatted_ambs (paths, args.format, args.jobs, failures)
+    if args.output == "-":
+        write_formatted_ambs (sys.stdout, formatted, args.format)
+    else:
+        with open (args.output, "w", encoding = "utf-8") as output_file:
+            write_formatted_ambs (output_file, formatted, args.format)
+    return report_load_failures (failures)
+
+def run_validate_command (args, paths):
+    failures = []
+    problem_count = 0
+    for batch in map_in_batches (validate_amb_batch, paths, args.jobs):
+        for (path, problems, failure) in batch:
+            if failure is not None:
+                failures.append (failure)
+            for problem in problems:
+                print (path + ": " + problem)
+            problem_count += len (problems)
+    print ("Validated {} files: {} size problems, {} files failed to load".format (len (paths), problem_count, len (failures)))
+    return problem_count + report_load_failures (failures)
+
+def make_argument_parser ():
+    parser = argparse.ArgumentParser (description = "Reads Civilization III AMB files.",
+                                      epilog = "Exit codes: 0 on success, 1 if files couldn't be loaded, failed validation, or nothing matched, 2 for invalid " +
+                                               "arguments.")
+    parser.add_argument ("--root", action = "append", help = "Civ 3 install directory, may be repeated. Defaults to $CIV3_ROOT")
+    parser.add_argument ("--art-dir", action = "append", help = "directory of unit folders containing AMBs, e.g. a mod's Art/Units, may be repeated. " +
+                                                                "Defaults to $CIV3_ART_DIRS")
+    parser.add_argument ("--jobs", type = int, default = 1, help = "number of processes to load files with, 0 to use all CPUs. Defaults to 1")
+    parser.add_argument ("--match", default = "", help = "only use files whose paths contain this text (case-insensitive)")
+    commands = parser.add_subparsers (dest = "command", required = True)
+
+    describe = commands.add_parser ("describe", help = "print the contents of the AMBs whose paths contain PATTERN")
+    describe.add_argument ("pattern")
+    describe.add_argument ("--format", choices = dump_formats, default = "text")
+
+    stats = commands.add_parser ("stats", help = "run the investigate_format checks over all files")
+    stats.add_argument ("--json", action = "store_true", help = "print the results as JSON")
+
+    toc = commands.add_parser ("toc", help = "list the chunks in each file without parsing them")
+    toc.add_argument ("--names", action = "store_true", help = "include effect, var, and track names")
+
+    export = commands.add_parser ("export", help = "write the parsed files to a SQLite database or as text, NDJSON, or JSON")
+    export.add_argument ("output", help = "output file, or - for stdout")
+    export.add_argument ("--format", choices = ("sqlite",) + dump_formats, default = "sqlite")
+    export.add_argument ("--incremental", action = "store_true", help = "only reparse files that changed since the last SQLite export. " +
+                                                                        "Can't be combined with --match")
+
+    commands.add_parser ("validate", help = "check that chunk size fields match their contents")
+    return parser
+
+# Each command function takes the parsed arguments and the paths of the files to work on and returns the number of problems found, counting files
+# that couldn't be loaded, so main can pick the exit code.
+command_functions = {"describe": run_describe_command,
+                     "stats"   : run_stats_command,
+                     "toc"     : run_toc_command,
+                     "export"  : run_export_command,
+                     "validate": run_validate_command}
+
+# Runs the script as a command line tool with the given arguments and returns the exit code
+def main (argv):
+    global ambs, all_amb_paths
+    parser = make_argument_parser ()
+    args = parser.parse_args (argv)
+    # An incremental export removes rows for files that aren't in the list it's given, so it has to be given the whole catalog
+    if args.command == "export" and args.incremental and args.match != "":
+        parser.error ("--match can't be used with export --incremental")
+    if args.jobs <= 0:
+        args.jobs = None
+    ambs = AmbCatalog (get_command_art_paths (args), intern_table = amb_intern_table)
+    all_amb_paths = ambs.paths
+
+    # describe's pattern and --match are both applied, so either can narrow down the other
+    patterns = [p.casefold () for p in [args.match, args.pattern if args.command == "describe" else ""] if p != ""]
+    paths = [p for p in all_amb_paths if all ([pattern in p.casefold () for pattern in patterns])]
+    if len (paths) == 0:
+        print ("No AMB files found" + (" matching \"" + "\" and \"".join (patterns) + "\"" if len (patterns) > 0 else ""), file = sys.stderr)
+        return 1
+
+    try:
+        problem_count = command_functions[args.command] (args, paths)
+    except BrokenPipeError:
+        # Output was piped into a program that stopped reading, e.g. head. Point stdout at devnull so Python doesn't complain again on exit.
+        os.dup2 (os.open (os.devnull, os.O_WRONLY), sys.stdout.fileno ())
+        return 1
+    except Exception as e:
+        print (type (e).__name__ + ": " + str (e), file = sys.stderr)
+        return 1
+    return 1 if problem_count > 0 else 0
+
+if run_as_command:
+    sys.exit (main (sys.argv[1:]))